@@ -30,37 +30,76 @@
 
 VERSION = '1.0'
 
+import logging
+
 import libavg
 
 import engine
 import states
 import widgets
 import score
+import consts
+import analytics
+import metrics
+import latency
+import recorder
+import snapshot
+
+
+logger = logging.getLogger(__name__)
+
 
 class EmpCommand(engine.GameDiv):
+    HISCORE_FILE = 'hiscore'
+    ANALYTICS_DIR = consts.ANALYTICS_DIR
+    SNAPSHOT_FILE = consts.SNAPSHOT_FILE
+
     def createGame(self):
         self.difficultyLevel = 1
 
-        engine.SoundManager.init(self)
-
-        self.scoreDatabase = score.HiscoreDatabase(self)
-
-        engine.SoundManager.allocate('bonus_alert.ogg')
-        engine.SoundManager.allocate('bonus_drop.ogg')
-        engine.SoundManager.allocate('click.ogg')
-        engine.SoundManager.allocate('selection.ogg')
-        engine.SoundManager.allocate('emp.ogg', 5)
-        engine.SoundManager.allocate('enemy_exp1.ogg', 2)
-        engine.SoundManager.allocate('enemy_exp2.ogg', 2)
-        engine.SoundManager.allocate('enemy_exp3.ogg', 2)
-        engine.SoundManager.allocate('enemy_exp4.ogg', 2)
-        engine.SoundManager.allocate('enemy_exp5.ogg', 2)
-        engine.SoundManager.allocate('low_ammo.ogg')
-        engine.SoundManager.allocate('missile_launch.ogg', 5)
-        engine.SoundManager.allocate('nuke.ogg')
-        engine.SoundManager.allocate('nuke_launch.ogg')
-        engine.SoundManager.allocate('target_destroy.ogg', 5)
-        engine.SoundManager.allocate('target_hit.ogg')
+        if self.ANALYTICS_DIR:
+            self.analytics = analytics.AnalyticsLog(self.ANALYTICS_DIR)
+        else:
+            self.analytics = None
+
+        if self.SNAPSHOT_FILE:
+            self.snapshots = snapshot.SnapshotWriter(self.SNAPSHOT_FILE)
+        else:
+            self.snapshots = None
+
+        if consts.METRICS_PORT:
+            self.metricsServer = metrics.MetricsServer(metrics.registry,
+                    int(consts.METRICS_PORT))
+            self.metricsServer.start()
+            collector = metrics.GameCollector(self, metrics.registry)
+            libavg.player.subscribe(libavg.player.ON_FRAME, collector.onFrame)
+        else:
+            self.metricsServer = None
+
+        if consts.LATENCY_REPORT_INTERVAL:
+            engine.clock.setInterval(int(consts.LATENCY_REPORT_INTERVAL),
+                    lambda: logger.info(latency.tracker.report()))
+
+        engine.sounds.init(self)
+
+        self.scoreDatabase = score.HiscoreDatabase(self, fileName=self.HISCORE_FILE)
+
+        engine.sounds.allocate('bonus_alert.ogg')
+        engine.sounds.allocate('bonus_drop.ogg')
+        engine.sounds.allocate('click.ogg')
+        engine.sounds.allocate('selection.ogg')
+        engine.sounds.allocate('emp.ogg', 5)
+        engine.sounds.allocate('enemy_exp1.ogg', 2)
+        engine.sounds.allocate('enemy_exp2.ogg', 2)
+        engine.sounds.allocate('enemy_exp3.ogg', 2)
+        engine.sounds.allocate('enemy_exp4.ogg', 2)
+        engine.sounds.allocate('enemy_exp5.ogg', 2)
+        engine.sounds.allocate('low_ammo.ogg')
+        engine.sounds.allocate('missile_launch.ogg', 5)
+        engine.sounds.allocate('nuke.ogg')
+        engine.sounds.allocate('nuke_launch.ogg')
+        engine.sounds.allocate('target_destroy.ogg', 5)
+        engine.sounds.allocate('target_hit.ogg')
 
         self.sequencer.registerState('start', states.Start())
         self.sequencer.registerState('about', states.About())
@@ -70,8 +109,49 @@ class EmpCommand(engine.GameDiv):
         self.sequencer.registerState('hiscore', states.Hiscore())
 
         self.setupPointer(widgets.CrossHair())
-        self.sequencer.changeState('start')
+
+        if consts.RESUME_FILE:
+            resumeData = snapshot.load(consts.RESUME_FILE)
+        elif self.SNAPSHOT_FILE:
+            resumeData = snapshot.load(self.SNAPSHOT_FILE, maxAge=consts.SNAPSHOT_MAX_AGE,
+                    consume=True)
+        else:
+            resumeData = None
+
+        if resumeData is not None:
+            self.sequencer.getState('game').resume(resumeData)
+            self.sequencer.changeState('game')
+        else:
+            self.sequencer.changeState('start')
+
+    def onCursorDown(self, event):
+        latency.tracker.begin(event)
+        super(EmpCommand, self).onCursorDown(event)
+        latency.tracker.end()
+
+    def onFrame(self):
+        try:
+            latency.tracker.onFrame()
+            super(EmpCommand, self).onFrame()
+        except Exception as e:
+            recorder.flight.record(recorder.EXCEPTION, e.__class__.__name__)
+            recorder.flight.dump('exception')
+            raise
+
+    def onExit(self):
+        if consts.LATENCY_REPORT_INTERVAL:
+            logger.info(latency.tracker.report())
+
+        if self.analytics is not None:
+            self.analytics.close()
+
+        if self.snapshots is not None:
+            self.snapshots.close()
+
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
 
 
 def run():
+    engine.setClock(engine.createClock(consts.CLOCK))
     libavg.app.App().run(EmpCommand(), app_resolution='', app_fullscreen='true')
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import os
+import math
+import glob
+import time
+import struct
+import logging
+import threading
+import Queue
+
+
+logger = logging.getLogger(__name__)
+
+
+OUTCOME_CLEARED = 0
+OUTCOME_GAMEOVER = 1
+OUTCOME_ABORTED = 2
+
+
+class RecordType(object):
+    '''
+    Fixed size, little endian binary record. Fields are (name, struct code) pairs,
+    the codes are shared with numpy so that log files can be loaded as
+    structured arrays straight away.
+    '''
+    def __init__(self, name, version, fields):
+        self.name = name
+        self.version = version
+        self.fields = fields
+        self.names = [f[0] for f in fields]
+        self.struct = struct.Struct('<' + ''.join(f[1] for f in fields))
+
+    def pack(self, record):
+        return self.struct.pack(*[record[n] for n in self.names])
+
+    def getDType(self):
+        return [(n, '<' + c) for n, c in self.fields]
+
+    def getFileName(self, timestamp):
+        return '%s-v%d-%s.bin' % (self.name, self.version,
+                time.strftime('%Y%m%d', time.localtime(timestamp)))
+
+    def getGlob(self):
+        return '%s-v%d-*.bin' % (self.name, self.version)
+
+
+WAVE_RECORD = RecordType('waves', 1, (
+    ('time', 'd'),
+    ('difficulty', 'B'),
+    ('wave', 'H'),
+    ('outcome', 'B'),
+    ('enemiesSpawned', 'H'),
+    ('enemiesDestroyed', 'H'),
+    ('initialEnemies', 'H'),
+    ('ammoFired', 'H'),
+    ('initialAmmo', 'H'),
+    ('citiesLost', 'B'),
+    ('nukeFired', 'B'),
+    ('ammoBonuses', 'H'),
+    ('nukeBonuses', 'H'),
+    ('duration', 'I'),
+    ('frameP50', 'f'),
+    ('frameP95', 'f'),
+    ('frameP99', 'f'),
+    ('frameMax', 'f'),
+))
+
+GAME_RECORD = RecordType('games', 1, (
+    ('time', 'd'),
+    ('difficulty', 'B'),
+    ('waves', 'H'),
+    ('outcome', 'B'),
+    ('score', 'I'),
+    ('duration', 'I'),
+    ('enemiesDestroyed', 'I'),
+    ('ammoFired', 'I'),
+))
+
+
+def percentiles(values, ps):
+    '''Nearest-rank percentiles of an unsorted sequence'''
+    if not values:
+        return [0] * len(ps)
+
+    values = sorted(values)
+    n = len(values)
+    return [values[min(n - 1, max(0, int(math.ceil(p / 100.0 * n)) - 1))] for p in ps]
+
+
+class AnalyticsLog(object):
+    '''
+    Append-only log of wave and game records.
+    Records are packed on the caller's thread and handed to a background writer,
+    which appends them to daily files in batches.
+    The log disables itself when the directory can't be written, logging becomes
+    a no-op: telemetry must never take the game down.
+    '''
+    BATCH_SIZE = 64
+    FLUSH_INTERVAL = 5
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.enabled = True
+        self.__queue = Queue.Queue()
+        self.__thread = None
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        except (IOError, OSError) as e:
+            logger.warning('Cannot create the analytics directory %s, analytics '
+                    'disabled: %s' % (directory, e))
+            self.enabled = False
+            return
+
+        self.__thread = threading.Thread(target=self.__run, name='AnalyticsLog')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def logWave(self, record):
+        self.__log(WAVE_RECORD, record)
+
+    def logGame(self, record):
+        self.__log(GAME_RECORD, record)
+
+    def close(self):
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+    def __log(self, recordType, record):
+        if not self.enabled:
+            return
+
+        record.setdefault('time', time.time())
+        self.__queue.put((recordType.getFileName(record['time']),
+                recordType.pack(record)))
+
+    def __run(self):
+        batch = []
+        lastFlush = time.time()
+        running = True
+
+        while running:
+            try:
+                item = self.__queue.get(timeout=self.FLUSH_INTERVAL)
+            except Queue.Empty:
+                item = False
+
+            if item is None:
+                running = False
+            elif item:
+                batch.append(item)
+
+            if batch and (not running or len(batch) >= self.BATCH_SIZE or
+                    time.time() - lastFlush >= self.FLUSH_INTERVAL):
+                if self.enabled:
+                    self.__write(batch)
+                batch = []
+                lastFlush = time.time()
+
+    def __write(self, batch):
+        files = {}
+        for fileName, data in batch:
+            files.setdefault(fileName, []).append(data)
+
+        for fileName, chunks in files.items():
+            try:
+                with open(os.path.join(self.directory, fileName), 'ab') as f:
+                    f.write(''.join(chunks))
+            except (IOError, OSError) as e:
+                logger.warning('Cannot write analytics to %s, analytics disabled: %s' %
+                        (fileName, e))
+                self.enabled = False
+                return
+
+
+def load(directory, recordType, since=None):
+    '''Loads all the records of a type as a numpy structured array'''
+    import numpy
+
+    dtype = numpy.dtype(recordType.getDType())
+    arrays = []
+    for fileName in sorted(glob.glob(os.path.join(directory, recordType.getGlob()))):
+        if since is not None and os.path.basename(fileName)[-12:-4] < since:
+            continue
+        arrays.append(numpy.fromfile(fileName, dtype=dtype))
+
+    if arrays:
+        return numpy.concatenate(arrays)
+    else:
+        return numpy.zeros(0, dtype=dtype)
+
+
+def rollup(directory, since=None):
+    '''
+    Aggregates the wave records by difficulty and wave, returns a list of dicts
+    sorted by (difficulty, wave)
+    '''
+    import numpy
+
+    waves = load(directory, WAVE_RECORD, since)
+    if not len(waves):
+        return []
+
+    keys = waves['difficulty'].astype(numpy.uint32) << 16 | waves['wave']
+    uniqueKeys, groups = numpy.unique(keys, return_inverse=True)
+    counts = numpy.bincount(groups)
+
+    def mean(values):
+        return numpy.bincount(groups, weights=values) / counts
+
+    fired = waves['ammoFired'].astype(numpy.float64)
+    destroyed = waves['enemiesDestroyed'].astype(numpy.float64)
+
+    stats = {
+        'accuracy': (numpy.bincount(groups, weights=destroyed) * 100 /
+                numpy.maximum(numpy.bincount(groups, weights=fired), 1)),
+        'citiesLost': mean(waves['citiesLost']),
+        'gameOverRate': mean(waves['outcome'] == OUTCOME_GAMEOVER),
+        'nukeRate': mean(waves['nukeFired']),
+        'bonuses': mean(waves['ammoBonuses'] + waves['nukeBonuses']),
+        'duration': mean(waves['duration']),
+        'frameP95': mean(waves['frameP95']),
+    }
+
+    # Worst frame per group
+    frameMax = numpy.zeros(len(uniqueKeys))
+    numpy.maximum.at(frameMax, groups, waves['frameMax'])
+
+    result = []
+    for i, key in enumerate(uniqueKeys):
+        row = {
+            'difficulty': int(key >> 16),
+            'wave': int(key & 0xffff),
+            'count': int(counts[i]),
+            'frameMax': float(frameMax[i]),
+        }
+        for name, values in stats.items():
+            row[name] = float(values[i])
+        result.append(row)
+
+    return result
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import os
+import hashlib
+import logging
+
+from libavg import avg, Point2D
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import consts
+
+
+logger = logging.getLogger(__name__)
+
+
+class AssetCache(object):
+    '''
+    Images pre-scaled to the size they're drawn at, so that the full-size bitmaps
+    don't have to be resampled by the GPU every frame.
+    Scaled copies are generated on first use (requires PIL) and stored in
+    <directory>/v<VERSION>/<width>x<height>/, keyed by the source content hash.
+    Without PIL or a cache directory the original images are used.
+    '''
+    VERSION = 1
+
+    def __init__(self):
+        self.mediaDir = None
+        self.path = None
+        self.hits = 0
+        self.misses = 0
+        self.__hashes = {}
+        self.__mediaSizes = {}
+
+    def setup(self, mediaDir, resolution, directory=consts.ASSET_CACHE_DIR):
+        self.mediaDir = mediaDir
+        if not directory or Image is None:
+            if directory:
+                logger.warning('PIL not available, images will be scaled at runtime')
+            self.path = None
+            return
+
+        path = os.path.join(directory, 'v%d' % self.VERSION,
+                '%dx%d' % (resolution[0], resolution[1]))
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        except OSError as e:
+            logger.warning('Cannot create the asset cache %s: %s' % (path, e))
+            self.path = None
+        else:
+            logger.info('Asset cache: %s' % path)
+            self.path = path
+
+    def getMediaSize(self, href):
+        if href not in self.__mediaSizes:
+            source = self.__getSource(href)
+            if Image is not None:
+                # Only the header is read
+                size = Point2D(Image.open(source).size)
+            else:
+                size = avg.Bitmap(source).getSize()
+
+            self.__mediaSizes[href] = size
+
+        return Point2D(self.__mediaSizes[href])
+
+    def getScaled(self, href, size):
+        '''
+        Returns the href of the image pre-scaled to size, or href itself when it
+        can't be scaled (libavg scales the original at runtime then)
+        '''
+        size = (int(round(size[0])), int(round(size[1])))
+        try:
+            return self.__getScaled(href, size)
+        except (IOError, OSError) as e:
+            logger.warning('Cannot scale %s to %dx%d: %s' % (href, size[0], size[1], e))
+            return href
+
+    def prebuild(self, scale):
+        '''
+        Builds the scaled copies of every image of the media directory,
+        scale(mediaSize) gives the target size
+        '''
+        built = 0
+        for fileName in sorted(os.listdir(self.mediaDir)):
+            if fileName.endswith('.png'):
+                if self.getScaled(fileName, scale(self.getMediaSize(fileName))) != fileName:
+                    built += 1
+
+        return built
+
+    def __getScaled(self, href, size):
+        mediaSize = self.getMediaSize(href)
+
+        # Upscaling doesn't save anything
+        if (self.path is None or size[0] <= 0 or size[1] <= 0 or
+                size[0] >= mediaSize.x or size[1] >= mediaSize.y):
+            return href
+
+        name, ext = os.path.splitext(os.path.basename(href))
+        target = os.path.join(self.path, '%s-%s-%dx%d.png' % (name,
+                self.__getHash(href), size[0], size[1]))
+
+        if os.path.exists(target):
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.__scale(self.__getSource(href), target, size)
+
+        return target
+
+    def __getSource(self, href):
+        return os.path.join(self.mediaDir, href)
+
+    def __getHash(self, href):
+        if href not in self.__hashes:
+            with open(self.__getSource(href), 'rb') as f:
+                self.__hashes[href] = hashlib.sha1(f.read()).hexdigest()[:12]
+
+        return self.__hashes[href]
+
+    def __scale(self, source, target, size):
+        logger.info('Scaling %s to %dx%d' % (source, size[0], size[1]))
+        image = Image.open(source)
+        if hasattr(Image, 'LANCZOS'):
+            image = image.resize(size, Image.LANCZOS)
+        else:
+            image = image.resize(size, Image.ANTIALIAS)
+
+        # Written aside and renamed, a partial file must never be picked up
+        tmpFile = '%s.%d.tmp' % (target, os.getpid())
+        try:
+            image.save(tmpFile, 'PNG')
+            os.rename(tmpFile, target)
+        finally:
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+
+
+cache = AssetCache()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import math
+import random
+
+from libavg import avg, Point2D
+
+import engine
+import consts
+from gameobjs import *
+
+
+class Contact(object):
+    '''Synthetic contact, dispatching motion and release to its subscribers'''
+    def __init__(self, cursorid):
+        self.id = cursorid
+        self.__subscribers = {}
+
+    def subscribe(self, messageID, cb):
+        self.__subscribers.setdefault(messageID, []).append(cb)
+
+    def notify(self, messageID, event):
+        for cb in list(self.__subscribers.get(messageID, [])):
+            cb(event)
+
+
+class TouchEvent(object):
+    '''Synthetic touch, carrying what the game handlers read out of a CursorEvent'''
+    source = avg.Event.TOUCH
+
+    def __init__(self, pos, cursorid, contact=None, type=avg.Event.CURSOR_DOWN):
+        self.pos = Point2D(pos)
+        self.cursorid = cursorid
+        self.contact = contact
+        self.type = type
+
+
+class BonusDrag(object):
+    '''Drag&drop of a bonus onto a turret, spread over a few frames'''
+    def __init__(self, bonus, turret, cursorid, duration):
+        self.bonus = bonus
+        self.duration = duration
+        self.__contact = Contact(cursorid)
+        self.__cursorid = cursorid
+        self.__startPos = bonus.getCenter()
+        self.__endPos = turret.getHitPos()
+        self.__elapsed = 0
+
+        bonus._node.notifySubscribers(avg.Node.CURSOR_DOWN,
+                [TouchEvent(self.__startPos, cursorid, self.__contact)])
+
+    def update(self, dt):
+        '''Moves the finger, returns False once the bonus has been released'''
+        self.__elapsed = min(self.__elapsed + dt, self.duration)
+        pos = self.__startPos + (self.__endPos - self.__startPos) * (
+                float(self.__elapsed) / self.duration)
+        self.__contact.notify(avg.Contact.CURSOR_MOTION, TouchEvent(pos,
+                self.__cursorid, self.__contact, avg.Event.CURSOR_MOTION))
+
+        if self.__elapsed == self.duration:
+            self.__contact.notify(avg.Contact.CURSOR_UP, TouchEvent(pos,
+                    self.__cursorid, self.__contact, avg.Event.CURSOR_UP))
+            return False
+        else:
+            return True
+
+
+class Finger(object):
+    def __init__(self, bot, cursorid):
+        self.bot = bot
+        self.cursorid = cursorid
+        self.drag = None
+        self.__cooldown = random.uniform(0, bot.getTouchInterval())
+
+    def update(self, dt):
+        if self.drag is not None:
+            if not self.drag.update(dt):
+                self.drag = None
+            return
+
+        self.__cooldown -= dt
+        if self.__cooldown <= 0:
+            self.__cooldown += self.bot.getTouchInterval() * random.uniform(0.5, 1.5)
+            self.bot.act(self)
+
+
+class Bot(object):
+    '''
+    Synthetic player: computes intercept points of the live enemies and injects
+    touches through the same path of the real ones (GameDiv.onCursorDown).
+    Ready bonuses are dragged onto turrets.
+
+    skill (0..1) affects aiming accuracy, target prioritisation and dragging speed,
+    touchRate is expressed in touches per second per finger.
+    '''
+    CURSORID_BASE = 10000
+    MAX_FINGERS = 20
+    EXPLOSION_LEAD = 0.25
+    DRAG_DURATION = 300
+    CLAIM_MARGIN = 200
+
+    def __init__(self, mainDiv, touchRate=2.5, skill=0.7, fingers=1,
+            dragBonuses=True):
+        if not 1 <= fingers <= self.MAX_FINGERS:
+            raise ValueError('Fingers must be between 1 and %d' % self.MAX_FINGERS)
+        if touchRate <= 0:
+            raise ValueError('Invalid touch rate %s' % touchRate)
+
+        self.mainDiv = mainDiv
+        self.touchRate = touchRate
+        self.skill = max(0, min(skill, 1))
+        self.dragBonuses = dragBonuses
+        self.taps = 0
+        self.drags = 0
+
+        self.__claims = {}
+        self.__fingers = [Finger(self, self.CURSORID_BASE + i) for i in xrange(fingers)]
+
+    def reset(self):
+        self.__claims = {}
+        for finger in self.__fingers:
+            finger.drag = None
+
+    def getWorld(self):
+        return self.mainDiv.sequencer.getState('game').world
+
+    def getTouchInterval(self):
+        return 1000.0 / self.touchRate
+
+    def update(self, dt):
+        now = engine.clock.getTime()
+        for enemy, expiry in self.__claims.items():
+            if expiry < now:
+                del self.__claims[enemy]
+
+        for finger in self.__fingers:
+            finger.update(dt)
+
+    def act(self, finger):
+        if self.dragBonuses and random.random() < self.skill and self.__startDrag(finger):
+            return
+
+        enemy = self.__pickEnemy()
+        if enemy is not None:
+            aim, eta = self.getIntercept(enemy)
+            self.__claims[enemy] = engine.clock.getTime() + eta + self.CLAIM_MARGIN
+            self.tap(aim + self.__getAimError(), finger.cursorid)
+
+    def tap(self, pos, cursorid):
+        self.taps += 1
+        self.mainDiv.onCursorDown(TouchEvent(pos, cursorid))
+
+    def getIntercept(self, enemy):
+        '''
+        Returns the point where an EMP fired now would catch the enemy, along with
+        the estimated flight time (ms)
+        '''
+        enemyPos = enemy.traj.pos2
+        velocity = enemy.speedVector(1)
+
+        game = self.mainDiv.sequencer.getState('game')
+        turret = game.selectTurret(enemyPos)
+        if turret is None:
+            return enemyPos, 0
+
+        speed = (game.world.norm.r(sum(TurretMissile.speedRange) / 2.0) /
+                consts.DELTAT_NORM_FACTOR * game.world.speedMul)
+        lead = EmpExplosion.DURATION * self.EXPLOSION_LEAD
+
+        # Second pass: the turret which fires depends on the aim point
+        for i in xrange(2):
+            eta = self.__solveIntercept(enemyPos - turret.getHitPos(), velocity, speed)
+            aim = enemyPos + velocity * (eta + lead)
+            nextTurret = game.selectTurret(aim)
+            if nextTurret is None or nextTurret is turret:
+                break
+            turret = nextTurret
+
+        return aim, eta
+
+    def __solveIntercept(self, distance, velocity, speed):
+        # |distance + velocity * t| = speed * t
+        a = velocity.x ** 2 + velocity.y ** 2 - speed ** 2
+        b = 2 * (distance.x * velocity.x + distance.y * velocity.y)
+        c = distance.x ** 2 + distance.y ** 2
+
+        if abs(a) < 1e-9:
+            if b >= 0:
+                return 0
+            return -c / b
+
+        delta = b ** 2 - 4 * a * c
+        if delta < 0:
+            return 0
+
+        roots = [(-b + sign * math.sqrt(delta)) / (2 * a) for sign in (-1, 1)]
+        roots = [t for t in roots if t > 0]
+
+        return min(roots) if roots else 0
+
+    def __pickEnemy(self):
+        world = self.getWorld()
+        enemies = [e for e in world.filter(world.missiles, Enemy)
+                if e not in self.__claims]
+        if not enemies:
+            return None
+
+        if random.random() < self.skill:
+            return min(enemies, key=self.__getTimeToImpact)
+        else:
+            return random.choice(enemies)
+
+    def __getTimeToImpact(self, enemy):
+        return ((enemy.targetPoint - enemy.traj.pos2).getNorm() /
+                max(enemy.speedVector(1).getNorm(), 1e-9))
+
+    def __startDrag(self, finger):
+        dragged = [f.drag.bonus for f in self.__fingers if f.drag is not None]
+        world = self.getWorld()
+        bonuses = [b for b in world.bonuses if b.isReady() and b not in dragged]
+        turrets = world.filter(world.targets, Turret)
+        if not bonuses or not turrets:
+            return False
+
+        bonus = bonuses[0]
+        if isinstance(bonus, AmmoBonus):
+            turret = min(turrets, key=lambda t: t.getAmmo())
+        else:
+            turret = max(turrets, key=lambda t: t.lives)
+
+        finger.drag = BonusDrag(bonus, turret, finger.cursorid,
+                self.DRAG_DURATION * (2 - self.skill))
+        self.drags += 1
+
+        return True
+
+    def __getAimError(self):
+        spread = self.getWorld().norm.r(consts.BOT_MAX_AIM_ERROR) * (1 - self.skill)
+        return Point2D(random.uniform(-spread, spread), random.uniform(-spread, spread))
@@ -32,6 +32,37 @@ import os
 
 DEBUG = os.getenv('EMP_DEBUG', False)
 ENABLE_PROFILING = os.getenv('EMP_PROFILE', False)
+# realtime, scaled:<factor>, free[:<step ms>]
+CLOCK = os.getenv('EMP_CLOCK', 'realtime')
+# Empty to disable
+ANALYTICS_DIR = os.getenv('EMP_ANALYTICS_DIR',
+        os.path.join(os.path.expanduser('~'), '.empcommand', 'analytics'))
+# Port of the localhost metrics server, empty to disable
+METRICS_PORT = os.getenv('EMP_METRICS_PORT', '')
+METRICS_PUBLISH_INTERVAL = 1000
+# Logs a touch latency breakdown every n ms, empty to disable
+LATENCY_REPORT_INTERVAL = os.getenv('EMP_LATENCY_REPORT', '')
+# Pre-scaled images, empty to disable
+ASSET_CACHE_DIR = os.getenv('EMP_ASSET_CACHE',
+        os.path.join(os.path.expanduser('~'), '.empcommand', 'assets'))
+# Flight recorder dumps, empty to disable the recorder
+RECORDER_DIR = os.getenv('EMP_RECORDER_DIR',
+        os.path.join(os.path.expanduser('~'), '.empcommand', 'recordings'))
+RECORDER_CAPACITY = 16384
+RECORDER_HITCH_THRESHOLD = 250
+RECORDER_DUMP_INTERVAL = 60000
+# Snapshot of the ongoing game, resumed on start if recent enough. Empty to disable
+SNAPSHOT_FILE = os.getenv('EMP_SNAPSHOT',
+        os.path.join(os.path.expanduser('~'), '.empcommand', 'snapshot'))
+SNAPSHOT_INTERVAL = 5000
+SNAPSHOT_MAX_AGE = 600000
+# Snapshot to start from, whatever its age (eg: late wave benchmarks)
+RESUME_FILE = os.getenv('EMP_RESUME', '')
+# Max nodes per sprite layer, <layer>=<max>,... Cosmetic layers shed their oldest
+# sprites when exceeding it, the others are only logged. Empty to disable
+NODE_BUDGETS = os.getenv('EMP_NODE_BUDGETS', 'TextFeedback=20,TouchFeedback=40')
+# Menus drop to IDLE_FRAMERATE after n ms without input, 0 to disable
+IDLE_TIMEOUT = int(os.getenv('EMP_IDLE_TIMEOUT', 30000))
 
 ORIGINAL_SIZE = (1280, 800)
 
@@ -50,10 +81,21 @@ WAVE_DURATION = 45
 AMMO_ENEMIES_MULT = 1.3
 GREAT_HITS = 3
 NUKE_HITS = 4
+NUKE_MAX_SECONDARY_EXPLOSIONS = 8
+NUKE_MAX_SECONDARY_SOUNDS = 3
 TURRETS_AMOUNT = 3
 ULTRASPEED_MISSILE_MUL = 7
 DELTAT_NORM_FACTOR = 17
+NOMINAL_FRAMERATE = 60
+FREERUN_FRAMERATE = 1000
+IDLE_FRAMERATE = 10
+# Vertical blanks per frame of the realtime clock (libavg's default)
+VBLANK_FRAMERATE = 1
 MAX_INSTANCE_SOUNDS = 10
+TEXT_FEEDBACK_MAX_SAME = 3
+QUALITY_FRAME_BUDGET = 1000.0 / NOMINAL_FRAMERATE * 1.25
+# ms per frame spent preparing the next wave during the results
+WAVE_PREPARE_BUDGET = 2
 
 BONUS_AVAILABILITY_TICKS = 40
 
@@ -66,3 +108,28 @@ ENEMY_DESTROYED_SCORE = 50
 SOUND_FREQUENCY = 44100
 SOUND_BUFFER_SIZE = 1024
 SOUND_VOICES = 32
+# Sound requests merged in a frame get louder by SOUND_MERGE_GAIN per doubling
+SOUND_MERGE_GAIN = 0.25
+# Min ms between two plays of a sample, the requests in between are dropped
+SOUND_RETRIGGER_INTERVALS = {
+    'emp.ogg': 40,
+    'enemy_exp1.ogg': 40,
+    'enemy_exp2.ogg': 40,
+    'enemy_exp3.ogg': 40,
+    'enemy_exp4.ogg': 40,
+    'enemy_exp5.ogg': 40,
+    'target_hit.ogg': 60,
+    'target_destroy.ogg': 60,
+    'missile_launch.ogg': 30,
+    'buzz.ogg': 100,
+}
+
+BOT_MAX_AIM_ERROR = 150
+
+SOAK_WARMUP_SAMPLES = 5
+SOAK_MIN_SAMPLES = 10
+SOAK_ATTRACT_TIME = 20000
+# Tolerated growth per wave: bytes of RSS, python objects, bytes traced by tracemalloc
+SOAK_RSS_TOLERANCE = 262144
+SOAK_OBJECTS_TOLERANCE = 50
+SOAK_MEMORY_TOLERANCE = 4096
@@ -30,12 +30,16 @@
 
 import os
 import math
+import time
 import random
 import logging
+import collections
 import libavg
 from libavg import avg, Point2D, player
 
 import consts
+import assets
+import recorder
 
 
 logger = logging.getLogger(__name__)
@@ -49,53 +53,151 @@ class EngineError(Exception):
 
 
 class SoundManager(object):
-    objects = {}
-
-    @classmethod
-    def init(cls, parent):
-        cls.parent = parent
-
-    @classmethod
-    def getSample(cls, fileName, loop=False):
+    '''
+    Pool of preallocated sound samples, engine.sounds is the application one.
+    Between beginFrame() and flush() play requests are queued and merged: a
+    sample plays at most once per frame, louder when requested several times.
+    A sample isn't played again before its retrigger interval (ms) elapsed.
+    '''
+    def __init__(self, retriggerIntervals=consts.SOUND_RETRIGGER_INTERVALS):
+        self.objects = {}
+        # Samples started and not known to have ended, see getNumVoices()
+        self.voices = set()
+        self.parent = None
+        self.retriggerIntervals = dict(retriggerIntervals)
+        self.requests = 0
+        self.merged = 0
+        self.limited = 0
+        self.__batching = False
+        # fileName: [count, volume], in order of request
+        self.__pending = {}
+        self.__pendingOrder = []
+        self.__lastPlayed = {}
+
+    def init(self, parent):
+        self.parent = parent
+
+    def getSample(self, fileName, loop=False):
         return avg.SoundNode(href=os.path.join('snd', fileName), loop=loop,
-                parent=cls.parent)
+                parent=self.parent)
 
-    @classmethod
-    def allocate(cls, fileName, nodes=1):
-        if fileName in cls.objects:
+    def allocate(self, fileName, nodes=1):
+        if fileName in self.objects:
             raise RuntimeError('Sound sample %s has been already allocated' % fileName)
 
         slst = []
         for i in xrange(0, nodes):
-            s = SoundManager.getSample(fileName)
+            s = self.getSample(fileName)
+            s.subscribe(s.END_OF_FILE, lambda s=s: self.voices.discard(s))
             slst.append(s)
 
-        cls.objects[fileName] = slst
+        self.objects[fileName] = slst
 
-    @classmethod
-    def play(cls, fileName, randomVolume=False, volume=None):
-        if not fileName in cls.objects:
+    def play(self, fileName, randomVolume=False, volume=None):
+        if not fileName in self.objects:
             raise RuntimeError('Sound sample %s hasn\'t been allocated' % fileName)
 
-        mySound = cls.objects[fileName].pop(0)
-        mySound.stop()
-
+        self.requests += 1
         if volume is not None:
             maxVol = volume
         else:
             maxVol = 1
 
         if randomVolume:
-            mySound.volume = random.uniform(0.2, maxVol)
-        elif volume is not None:
-            mySound.volume = volume
+            volume = random.uniform(0.2, maxVol)
+        else:
+            volume = maxVol
+
+        if not self.__batching:
+            self.__trigger(fileName, 1, volume)
+        elif fileName in self.__pending:
+            request = self.__pending[fileName]
+            request[0] += 1
+            request[1] = max(request[1], volume)
+        else:
+            self.__pending[fileName] = [1, volume]
+            self.__pendingOrder.append(fileName)
+
+    def beginFrame(self):
+        self.__batching = True
+
+    def flush(self):
+        '''Plays the requests queued since beginFrame()'''
+        self.__batching = False
+        pending, self.__pending = self.__pending, {}
+        pendingOrder, self.__pendingOrder = self.__pendingOrder, []
+
+        for fileName in pendingOrder:
+            count, volume = pending[fileName]
+            self.__trigger(fileName, count, volume)
+
+    def getNumVoices(self):
+        '''Pooled samples which are currently playing'''
+        # The end of file notification isn't a reliable bookkeeping on its own
+        return sum(1 for voice in self.voices if voice.state == avg.Node.PLAYING)
+
+    def __trigger(self, fileName, count, volume):
+        now = clock.getTime()
+        lastPlayed = self.__lastPlayed.get(fileName)
+        if (lastPlayed is not None and
+                now - lastPlayed < self.retriggerIntervals.get(fileName, 0)):
+            self.limited += count
+            return
+
+        self.__lastPlayed[fileName] = now
+        if count > 1:
+            self.merged += count - 1
+            volume = min(volume * (1 + consts.SOUND_MERGE_GAIN * math.log(count, 2)), 1)
+
+        recorder.flight.record(recorder.SOUND, fileName, count)
+        mySound = self.objects[fileName].pop(0)
+        mySound.stop()
+        self.voices.add(mySound)
+        mySound.volume = volume
+        mySound.play()
 
-        sc = mySound.play()
+        self.objects[fileName].append(mySound)
 
-        cls.objects[fileName].append(mySound)
+
+class DeferredUpdates(object):
+    '''
+    Coalesces the node writes of the widgets, GameDiv.updates is the application
+    one. Between beginFrame() and flush() setters only record the target values
+    and mark the widget as dirty, flush() pushes the final values to the nodes.
+    Out of the frame (input handlers) updates are applied right away.
+    Dirty widgets implement _flush()
+    '''
+    def __init__(self):
+        self.__batching = False
+        self.__dirty = []
+
+    def schedule(self, widget):
+        if not self.__batching:
+            widget._flush()
+        elif not widget._dirty:
+            widget._dirty = True
+            self.__dirty.append(widget)
+
+    def beginFrame(self):
+        self.__batching = True
+
+    def flush(self):
+        self.__batching = False
+        dirty, self.__dirty = self.__dirty, []
+        try:
+            for widget in dirty:
+                widget._dirty = False
+                widget._flush()
+        finally:
+            # Skipped by an exception, their next update schedules them again
+            for widget in dirty:
+                widget._dirty = False
 
 
 class GameState(avg.DivNode):
+    # Only idle animations are running, the framerate can be lowered when unattended
+    IDLE_CAPABLE = False
+
     def __init__(self, parent=None, **kwargs):
         super(GameState, self).__init__(**kwargs)
         self.registerInstance(self, parent)
@@ -113,13 +215,16 @@ class GameState(avg.DivNode):
         self._init()
 
     def registerBgTrack(self, fileName, maxVolume=1):
-        self._bgTrack = SoundManager.getSample(fileName, loop=True)
+        self._bgTrack = sounds.getSample(fileName, loop=True)
         self._bgTrack.volume = maxVolume
         self._maxBgTrackVolume = maxVolume
 
     def update(self, dt):
         self._update(dt)
 
+    def frameRendered(self, frameTime):
+        self._frameRendered(frameTime)
+
     def onTouch(self, event):
         if not self._isFrozen:
             self._onTouch(event)
@@ -145,6 +250,7 @@ class GameState(avg.DivNode):
         self.opacity = 0
         if self._bgTrack:
             self._bgTrack.stop()
+        self.sequencer.stateLeft(self)
 
     def _init(self):
         pass
@@ -164,6 +270,10 @@ class GameState(avg.DivNode):
     def _update(self, dt):
         pass
 
+    def _frameRendered(self, frameTime):
+        '''Wall time (ms) since the previous frame, once per frame'''
+        pass
+
     def _onTouch(self, event):
         pass
 
@@ -224,6 +334,7 @@ class TransitionGameState(GameState):
     def __postTransOut(self):
         self._isFrozen = False
         self._postTransOut()
+        self.sequencer.stateLeft(self)
 
 
 class FadeGameState(TransitionGameState):
@@ -246,36 +357,71 @@ class FadeGameState(TransitionGameState):
 
 
 class Sequencer(object):
+    '''
+    Registered states are linked to the scene graph only while they're shown:
+    a state is detached once it has left (after its fade out, if any) and
+    attached again when entered, so that rendering and event dispatching only
+    deal with the active screen.
+    '''
     def __init__(self, parentNode):
-        self.__parentNode = parentNode
+        self.__statesDiv = avg.DivNode(parent=parentNode)
         self.__registeredStates = {}
+        self.__statesOrder = []
         self.__currentState = None
+        self.__currentHandle = None
         self.__entryHandle = None
 
     def registerState(self, handle, state):
         logger.info('Registering state %s: %s' % (handle, state))
-        self.__parentNode.appendChild(state)
+        self.__statesDiv.appendChild(state)
         state.registerSequencer(self)
         self.__registeredStates[handle] = state
+        self.__statesOrder.append(state)
+        census.watchState(handle, state)
+        self.__detach(state)
 
     def changeState(self, handle):
         newState = self.__getState(handle)
+        oldState = self.__currentState
 
-        if self.__currentState:
-            self.__currentState.leave()
+        # Switched before leave(), so that stateLeft() detaches a state that
+        # leaves right away
+        self.__currentState = newState
+        self.__currentHandle = handle
 
-        newState.enter()
-        logger.info('Changing state %s -> %s' % (self.__currentState, newState))
+        if oldState:
+            oldState.leave()
 
-        self.__currentState = newState
+        self.__attach(newState)
+        newState.enter()
+        logger.info('Changing state %s -> %s' % (oldState, newState))
+        recorder.flight.record(recorder.STATE, handle)
 
     def getState(self, handle):
         return self.__getState(handle)
 
+    def getCurrentHandle(self):
+        return self.__currentHandle
+
+    def getCurrentState(self):
+        return self.__currentState
+
+    def getStates(self):
+        return list(self.__statesOrder)
+
+    def stateLeft(self, state):
+        # The state might have been entered again before its fade out completed
+        if state is not self.__currentState:
+            self.__detach(state)
+
     def update(self, dt):
         if self.__currentState:
             self.__currentState.update(dt)
 
+    def frameRendered(self, frameTime):
+        if self.__currentState:
+            self.__currentState.frameRendered(frameTime)
+
     def propagateTouch(self, event):
         if self.__currentState:
             self.__currentState.onTouch(event)
@@ -288,6 +434,24 @@ class Sequencer(object):
         if self.__currentState:
             return self.__currentState.onKeyUp(event)
 
+    def __attach(self, state):
+        if state.getParent() is not None:
+            return
+
+        # Keeps the stacking order of the registration
+        index = 0
+        for other in self.__statesOrder:
+            if other is state:
+                break
+            elif other.getParent() is not None:
+                index += 1
+
+        self.__statesDiv.insertChild(state, index)
+
+    def __detach(self, state):
+        if state.getParent() is not None:
+            state.unlink(False)
+
     def __getState(self, handle):
         if handle in self.__registeredStates:
             return self.__registeredStates[handle]
@@ -334,23 +498,544 @@ class Normaliser(object):
         return nseq
 
 
+class Clock(object):
+    '''
+    Time source for the game logic.
+
+    Game code must read the time and schedule timers through the active clock
+    (engine.clock) instead of calling the player directly, so that the whole game
+    can be run faster than realtime.
+    Timers are delegated to the player: libavg drives timeouts, intervals and
+    animations from the frame time, which follows the clock once it's started.
+    '''
+    # Fixed framerate set on the player, None when it's synced to the vertical blank
+    framerate = None
+
+    def __init__(self):
+        self.frames = 0
+        self.__lastTime = None
+        self.__timers = set()
+
+    def start(self):
+        self._setupPlayer()
+        self.__lastTime = None
+
+    def tick(self):
+        '''Called once per frame, returns the elapsed virtual time (ms)'''
+        now = self.getTime()
+        if self.__lastTime is None:
+            dt = 0
+        else:
+            dt = now - self.__lastTime
+
+        self.__lastTime = now
+        self.frames += 1
+
+        return dt
+
+    def getTime(self):
+        return player.getFrameTime()
+
+    def setTimeout(self, time, cb):
+        def fire():
+            self.__timers.discard(tid)
+            cb()
+
+        tid = player.setTimeout(time, fire)
+        self.__timers.add(tid)
+        return tid
+
+    def setInterval(self, time, cb):
+        tid = player.setInterval(time, cb)
+        self.__timers.add(tid)
+        return tid
+
+    def clearInterval(self, tid):
+        self.__timers.discard(tid)
+        return player.clearInterval(tid)
+
+    def getNumTimers(self):
+        '''Timeouts and intervals which are still pending'''
+        return len(self.__timers)
+
+    def split(self, dt):
+        '''Steps the game logic is updated by to advance of dt'''
+        return (dt,)
+
+    def _setupPlayer(self):
+        raise NotImplementedError()
+
+
+class RealtimeClock(Clock):
+    '''Wall clock, the default'''
+    def _setupPlayer(self):
+        player.setFakeFPS(-1)
+
+    def __repr__(self):
+        return 'RealtimeClock'
+
+
+class ScaledClock(Clock):
+    '''
+    Virtual time running at factor times the wall clock, keeping the nominal
+    framerate. Every frame advances the time of factor nominal frame intervals,
+    the game logic is updated in steps of one nominal frame interval at most so
+    that fast objects don't go through each other between two updates.
+    Timers and animations still advance once per frame.
+    '''
+    def __init__(self, factor, framerate=consts.NOMINAL_FRAMERATE):
+        if factor <= 0:
+            raise EngineError('Invalid clock scale factor %s' % factor)
+
+        super(ScaledClock, self).__init__()
+        self.factor = float(factor)
+        self.framerate = framerate
+
+    def split(self, dt):
+        maxStep = 1000.0 / self.framerate
+        if dt <= maxStep:
+            return (dt,)
+
+        steps = int(math.ceil(dt / maxStep))
+        return (float(dt) / steps,) * steps
+
+    def _setupPlayer(self):
+        player.setFramerate(self.framerate)
+        player.setFakeFPS(self.framerate / self.factor)
+
+    def __repr__(self):
+        return 'ScaledClock x%.1f' % self.factor
+
+
+class FreeRunningClock(Clock):
+    '''
+    Virtual time advancing of a fixed step per frame, with frames produced as
+    fast as possible.
+    '''
+    def __init__(self, step=consts.DELTAT_NORM_FACTOR):
+        if step <= 0:
+            raise EngineError('Invalid clock step %s' % step)
+
+        super(FreeRunningClock, self).__init__()
+        self.step = step
+        self.framerate = consts.FREERUN_FRAMERATE
+
+    def _setupPlayer(self):
+        player.setFramerate(self.framerate)
+        player.setFakeFPS(1000.0 / self.step)
+
+    def __repr__(self):
+        return 'FreeRunningClock step=%dms' % self.step
+
+
+def createClock(spec):
+    '''
+    Builds a clock out of a textual spec:
+        realtime
+        scaled:<factor>
+        free[:<step ms>]
+    '''
+    args = spec.split(':')
+    kind = args.pop(0)
+
+    try:
+        if kind == 'realtime' and not args:
+            return RealtimeClock()
+        elif kind == 'scaled' and len(args) == 1:
+            return ScaledClock(float(args[0]))
+        elif kind == 'free' and len(args) <= 1:
+            return FreeRunningClock(*map(float, args))
+    except ValueError:
+        pass
+
+    raise EngineError('Invalid clock spec: %s' % spec)
+
+
+def setClock(newClock):
+    global clock
+    logger.info('Using clock: %s' % newClock)
+    clock = newClock
+
+
+class QualityGovernor(object):
+    '''
+    Steps through quality tiers, watching the wall time of a rolling window of
+    frames. A tier is dropped when the window average exceeds the frame budget,
+    and recovered only when it stays well below it for a while.
+    Game objects read the current settings as attributes (eg: quality.textFeedback)
+    '''
+    TIERS = (
+        {'cloudBlinkRatio': 1, 'maxExplosionSounds': None,
+            'touchFeedback': True, 'textFeedback': True, 'trailScale': 1,
+            'debugRefresh': 1},
+        {'cloudBlinkRatio': 3, 'maxExplosionSounds': 6,
+            'touchFeedback': True, 'textFeedback': True, 'trailScale': 1,
+            'debugRefresh': 5},
+        {'cloudBlinkRatio': 6, 'maxExplosionSounds': 4,
+            'touchFeedback': False, 'textFeedback': True, 'trailScale': 0.75,
+            'debugRefresh': 15},
+        {'cloudBlinkRatio': 0, 'maxExplosionSounds': 2,
+            'touchFeedback': False, 'textFeedback': False, 'trailScale': 0.5,
+            'debugRefresh': 30},
+    )
+    WINDOW = 30
+    DEGRADE_HOLD = 500
+    RECOVER_HOLD = 3000
+    RECOVER_FACTOR = 0.7
+
+    def __init__(self, budget=consts.QUALITY_FRAME_BUDGET):
+        self.budget = budget
+        self.enabled = True
+        self.changes = 0
+        self.__window = collections.deque(maxlen=self.WINDOW)
+        self.__lastFrame = None
+        self.__lastChange = 0
+        self.__setTier(0)
+
+    def update(self):
+        now = time.time() * 1000
+        if self.__lastFrame is not None:
+            self.__window.append(now - self.__lastFrame)
+        self.__lastFrame = now
+
+        if not self.enabled or len(self.__window) < self.WINDOW:
+            return
+
+        avgFrame = sum(self.__window) / len(self.__window)
+        sinceChange = now - self.__lastChange
+
+        if (avgFrame > self.budget and self.tier < len(self.TIERS) - 1 and
+                sinceChange > self.DEGRADE_HOLD):
+            self.__changeTier(self.tier + 1, avgFrame, now)
+        elif (avgFrame < self.budget * self.RECOVER_FACTOR and self.tier > 0 and
+                sinceChange > self.RECOVER_HOLD):
+            self.__changeTier(self.tier - 1, avgFrame, now)
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        if not enabled and self.tier != 0:
+            self.__changeTier(0, 0, time.time() * 1000)
+
+        # Frames measured while disabled don't count
+        self.__window.clear()
+        self.__lastFrame = None
+
+    def __changeTier(self, tier, avgFrame, now):
+        logger.warning('Quality tier %d -> %d (avg frame %.1fms, budget %.1fms)' % (
+                self.tier, tier, avgFrame, self.budget))
+        self.__setTier(tier)
+        self.__lastChange = now
+        self.__window.clear()
+        self.changes += 1
+
+    def __setTier(self, tier):
+        self.tier = tier
+        self.__dict__.update(self.TIERS[tier])
+
+
+class IdleGovernor(object):
+    '''
+    Lowers the framerate when no input has been received for timeout ms and the
+    current state is IDLE_CAPABLE, restoring it on the first input event.
+    CPU time saved is estimated against the CPU usage of the same states at
+    full rate, measured before going idle.
+    '''
+    def __init__(self, timeout=consts.IDLE_TIMEOUT, framerate=consts.IDLE_FRAMERATE):
+        self.timeout = timeout
+        self.framerate = framerate
+        self.enabled = bool(timeout)
+        self.idle = False
+        self.idleTime = 0
+        self.cpuSaved = 0
+        self.__idleCpu = 0
+        self.__activeTime = 0
+        self.__activeCpu = 0
+        self.__lastInput = time.time() * 1000
+        self.__lastSample = None
+        self.__sampleIdle = False
+        self.__sampleCapable = False
+        self.__handle = None
+        self.__fullFramerate = None
+        self.__fixedFramerate = None
+        self.__idleSince = None
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled and bool(self.timeout)
+        if not self.enabled and self.idle:
+            self.__leave(time.time() * 1000)
+
+    def onInput(self):
+        self.__lastInput = time.time() * 1000
+        if self.idle:
+            self.__leave(self.__lastInput)
+
+    def update(self, state, handle):
+        now = time.time() * 1000
+        self.__account(now)
+
+        if handle != self.__handle:
+            self.__handle = handle
+            self.__lastInput = now
+
+        capable = state is not None and state.IDLE_CAPABLE
+
+        if self.idle and not capable:
+            self.__leave(now)
+        elif (not self.idle and self.enabled and capable and
+                now - self.__lastInput > self.timeout and
+                avg.getNumRunningAnims() == 0):
+            self.__enter(now)
+
+        self.__sampleIdle = self.idle
+        self.__sampleCapable = capable
+
+    def getActiveCpuRatio(self):
+        '''CPU time per wall time spent on IDLE_CAPABLE states at full rate'''
+        if self.__activeTime:
+            return self.__activeCpu / self.__activeTime
+        else:
+            return None
+
+    def __account(self, now):
+        cpu = sum(os.times()[:2]) * 1000
+        if self.__lastSample is not None:
+            wall = now - self.__lastSample[0]
+            used = cpu - self.__lastSample[1]
+            if self.__sampleIdle:
+                self.idleTime += wall
+                self.__idleCpu += used
+            elif self.__sampleCapable:
+                self.__activeTime += wall
+                self.__activeCpu += used
+
+            ratio = self.getActiveCpuRatio()
+            if ratio is not None:
+                self.cpuSaved = max(0, ratio * self.idleTime - self.__idleCpu)
+
+        self.__lastSample = (now, cpu)
+
+    def __enter(self, now):
+        self.__fullFramerate = player.getFramerate()
+        # setFramerate() turns the vblank sync off, it's restored on leave
+        self.__fixedFramerate = clock.framerate
+        player.setFramerate(self.framerate)
+        # Idle frames are long on purpose
+        quality.setEnabled(False)
+        self.idle = True
+        self.__idleSince = now
+        logger.info('Idle after %ds without input, framerate %.0f -> %.0f' % (
+                self.timeout / 1000, self.__fullFramerate, self.framerate))
+
+    def __leave(self, now):
+        if self.__fixedFramerate is None:
+            player.setVBlankFramerate(consts.VBLANK_FRAMERATE)
+        else:
+            player.setFramerate(self.__fixedFramerate)
+        quality.setEnabled(True)
+        self.idle = False
+        self.__account(now)
+        self.__sampleIdle = False
+        logger.info('Leaving idle after %.1fs, CPU saved: %.1fs (%.1fs in %.1fs idle)' % (
+                (now - self.__idleSince) / 1000, self.cpuSaved / 1000,
+                self.__idleCpu / 1000, self.idleTime / 1000))
+
+
+class CoalescedMotion(object):
+    '''Last motion event of a contact in a frame, count tells how many were merged'''
+    def __init__(self, event):
+        self.cursorid = event.cursorid
+        self.source = event.source
+        self.contact = getattr(event, 'contact', None)
+        self.count = 0
+        self.velocity = None
+        self.merge(event)
+
+    def merge(self, event):
+        self.pos = Point2D(event.pos)
+        self.speed = getattr(event, 'speed', Point2D(0, 0))
+        self.count += 1
+
+
+class MotionCoalescer(object):
+    '''
+    Input stage for cursor motion: events are buffered per handler and cursor id
+    and only the last one of each contact is delivered, once per frame (flush()).
+    With estimateVelocity the delivered motions carry the contact velocity (px/ms)
+    since the previous frame.
+    '''
+    VELOCITY_TIMEOUT = 200
+
+    def __init__(self, estimateVelocity=True):
+        self.estimateVelocity = estimateVelocity
+        self.received = 0
+        self.delivered = 0
+        self.__pending = collections.OrderedDict()
+        self.__tracks = {}
+
+    def coalesce(self, handler):
+        '''Returns a CURSOR_MOTION handler which buffers the events for handler'''
+        def onMotion(event):
+            self.received += 1
+            key = (handler, event.cursorid)
+            motion = self.__pending.get(key)
+            if motion is None:
+                self.__pending[key] = CoalescedMotion(event)
+            else:
+                motion.merge(event)
+
+        return onMotion
+
+    def release(self, handler):
+        '''
+        Returns a CURSOR_UP handler which delivers the pending motion of the
+        contact before handler is called
+        '''
+        def onRelease(event):
+            self.flush(event.cursorid)
+            self.__tracks.pop(event.cursorid, None)
+            return handler(event)
+
+        return onRelease
+
+    def flush(self, cursorid=None):
+        if not self.__pending:
+            return
+
+        if cursorid is None:
+            pending = self.__pending.items()
+            self.__pending = collections.OrderedDict()
+        else:
+            pending = [(key, motion) for key, motion in self.__pending.items()
+                    if key[1] == cursorid]
+            for key, motion in pending:
+                del self.__pending[key]
+
+        now = clock.getTime()
+        for (handler, cursorid), motion in pending:
+            if self.estimateVelocity:
+                motion.velocity = self.__getVelocity(cursorid, motion.pos, now)
+            self.delivered += 1
+            handler(motion)
+
+        for cursorid, track in self.__tracks.items():
+            if now - track[1] > self.VELOCITY_TIMEOUT:
+                del self.__tracks[cursorid]
+
+    def __getVelocity(self, cursorid, pos, now):
+        track = self.__tracks.get(cursorid)
+        if track is None:
+            velocity = Point2D(0, 0)
+        elif track[1] == now:
+            # Already estimated this frame for another handler
+            return track[2]
+        else:
+            velocity = (pos - track[0]) / (now - track[1])
+
+        self.__tracks[cursorid] = (pos, now, velocity)
+        return velocity
+
+
+def countNodes(node):
+    '''Number of nodes of the subtree rooted at node, node included'''
+    count = 1
+    if isinstance(node, avg.DivNode):
+        for i in xrange(node.getNumChildren()):
+            count += countNodes(node.getChild(i))
+
+    return count
+
+
+def parseBudgets(spec):
+    '''<layer>=<max nodes>,... (see consts.NODE_BUDGETS)'''
+    budgets = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+
+        try:
+            name, budget = item.split('=')
+            budgets[name.strip()] = int(budget)
+        except ValueError:
+            raise EngineError('Invalid node budget: %s' % item)
+
+    return budgets
+
+
+class SceneCensus(object):
+    '''
+    Live node counts of the scene graph: sprite layers are counted every frame
+    (their direct children, as sprites are flat), the states in turn one per
+    frame, as their whole subtree has to be walked.
+    A layer beyond its budget is logged and, if it has been registered with a
+    shedder, gets its oldest sprites removed.
+    '''
+    def __init__(self, budgets=consts.NODE_BUDGETS):
+        self.budgets = parseBudgets(budgets)
+        self.layers = {}
+        self.states = {}
+        self.overruns = {}
+        self.shed = 0
+        self.__watchedLayers = {}
+        self.__watchedStates = []
+        self.__overBudget = set()
+        self.__stateIndex = 0
+
+    def watchLayer(self, name, node, shedder=None):
+        '''shedder(count) removes the count oldest sprites, returning how many it did'''
+        self.__watchedLayers[name] = (node, shedder)
+        self.layers[name] = 0
+
+    def watchState(self, handle, state):
+        self.__watchedStates.append((handle, state))
+
+    def update(self):
+        for name, (node, shedder) in self.__watchedLayers.iteritems():
+            count = node.getNumChildren()
+            budget = self.budgets.get(name)
+
+            if budget is not None and count > budget:
+                if name not in self.__overBudget:
+                    self.__overBudget.add(name)
+                    self.overruns[name] = self.overruns.get(name, 0) + 1
+                    logger.warning('Layer %s over budget: %d nodes (max %d)' % (
+                            name, count, budget))
+
+                if shedder is not None:
+                    shed = shedder(count - budget)
+                    self.shed += shed
+                    count -= shed
+            else:
+                self.__overBudget.discard(name)
+
+            self.layers[name] = count
+
+        if self.__watchedStates:
+            self.__stateIndex = (self.__stateIndex + 1) % len(self.__watchedStates)
+            handle, state = self.__watchedStates[self.__stateIndex]
+            self.states[handle] = countNodes(state)
+
+
 class GameDiv(libavg.app.MainDiv):
     def onInit(self):
         avg.WordsNode.addFontDir(libavg.utils.getMediaDir(__file__, 'fonts'))
         self.mediadir = libavg.utils.getMediaDir(__file__)
 
-        self.__elapsedTime = 0
         self.__pointer = None
+        self.__lastFrame = None
+        self.updates = DeferredUpdates()
         self.sequencer = Sequencer(self)
 
         norm.setSize(self.size)
+        assets.cache.setup(self.mediadir, self.size)
+        clock.start()
+        idle.setEnabled(isinstance(clock, RealtimeClock))
 
         self.createGame()
 
-        player.subscribe(player.KEY_DOWN, self.sequencer.propagateKeyDown)
+        player.subscribe(player.KEY_DOWN, self.onKeyDown)
         player.subscribe(player.KEY_UP, self.sequencer.propagateKeyUp)
         self.subscribe(self.CURSOR_DOWN, self.onCursorDown)
-        self.subscribe(self.CURSOR_MOTION, self.onCursorMotion)
+        self.subscribe(self.CURSOR_MOTION, motion.coalesce(self.onCursorMotion))
 
     def setupPointer(self, instance):
         self.appendChild(instance)
@@ -361,7 +1046,14 @@ class GameDiv(libavg.app.MainDiv):
     def createGame(self):
         raise NotImplementedError('createGame() must be overloaded')
 
+    def onKeyDown(self, event):
+        recorder.flight.record(recorder.INPUT, event.keyname)
+        idle.onInput()
+        return self.sequencer.propagateKeyDown(event)
+
     def onCursorDown(self, event):
+        recorder.flight.record(recorder.INPUT, 'down', event.pos.x, event.pos.y)
+        idle.onInput()
         self.sequencer.propagateTouch(event)
 
         if event.source == avg.Event.TOUCH and self.__pointer:
@@ -374,10 +1066,30 @@ class GameDiv(libavg.app.MainDiv):
             self.__pointer.refresh()
 
     def onFrame(self):
-        dt = player.getFrameTime() - self.__elapsedTime
-        self.sequencer.update(dt)
-
-        self.__elapsedTime = player.getFrameTime()
+        recorder.flight.onFrame(checkHitch=not idle.idle)
+        self.updates.beginFrame()
+        sounds.beginFrame()
+        motion.flush()
+        quality.update()
+        idle.update(self.sequencer.getCurrentState(), self.sequencer.getCurrentHandle())
+        for dt in clock.split(clock.tick()):
+            self.sequencer.update(dt)
+
+        # The game time steps above don't tell how long frames actually take
+        now = time.time() * 1000
+        if self.__lastFrame is not None:
+            self.sequencer.frameRendered(now - self.__lastFrame)
+        self.__lastFrame = now
+
+        census.update()
+        sounds.flush()
+        self.updates.flush()
 
 
 norm = Normaliser()
+clock = RealtimeClock()
+quality = QualityGovernor()
+idle = IdleGovernor()
+sounds = SoundManager()
+motion = MotionCoalescer()
+census = SceneCensus()
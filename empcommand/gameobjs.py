@@ -28,73 +28,319 @@
 # authors and should not be interpreted as representing official policies, either
 # expressed or implied, of OXullo Intersecans.
 
+import time
 import random
-import math
+import heapq
+import logging
+import itertools
 
-from libavg import avg, Point2D, player, app
+from libavg import avg, Point2D
 
 import engine
 import widgets
+import glyphs
 import consts
+import latency
+import recorder
 
 
 __all__ = ['Explosion', 'Target', 'Missile', 'TextFeedback', 'TouchFeedback', 'Bonus',
         'Turret', 'City', 'Enemy', 'TurretMissile', 'AmmoBonus', 'NukeBonus',
-        'EmpExplosion', 'EnemyExplosion']
+        'EmpExplosion', 'EnemyExplosion', 'NukeExplosion', 'GameStatus', 'GameListener',
+        'World', 'WavePlan']
+
+
+logger = logging.getLogger(__name__)
+
 
 def sqdist(p1, p2):
     pd = p1 - p2
     return pd.x ** 2 + pd.y ** 2
 
 
+def pointTuple(p):
+    return (p.x, p.y)
+
+
+class GameStatus(object):
+    '''
+    Live aggregates of the game objects of a world, kept up to date by their
+    lifecycle, so that the per-frame game status checks don't have to scan the
+    registries
+    '''
+    def __init__(self):
+        self.citiesAlive = 0
+        self.enemiesAlive = 0
+        self.turretMissiles = 0
+        self.activeEmps = 0
+        self.ammo = 0
+
+
+class GameListener(object):
+    '''
+    Receives the game events of a world. This one ignores them, it's used by
+    worlds that don't belong to a game state (benchmarks, tools)
+    '''
+    nukeFired = False
+
+    def enemiesKilled(self, count):
+        pass
+
+    def enemyDestroyed(self, enemy, target=None):
+        pass
+
+    def bonusDeployed(self, bonus):
+        pass
+
+    def updateAmmoGauge(self):
+        pass
+
+
+class World(object):
+    '''
+    Runtime state of a game session: object registries, sprite layers, explosion
+    callbacks, status aggregates, geometry normaliser and sound pool.
+    Game objects get the world they belong to as first argument, so that
+    independent sessions can coexist in the same process.
+    The normaliser sizes the game objects, the wave plans and the playfield;
+    the HUD widgets and the text glyphs are sized by engine.norm.
+    The clock, the quality governor and the latency tracker are process-wide,
+    as libavg drives a single player.
+    '''
+    def __init__(self, game=None, norm=None, sounds=None, difficulty=1):
+        # Receives the game events, see GameListener
+        self.game = game if game is not None else GameListener()
+        self.norm = norm if norm is not None else engine.norm
+        self.sounds = sounds if sounds is not None else engine.sounds
+        self.difficulty = difficulty
+        self.speedMul = 1
+        self.status = GameStatus()
+        # Game time (ms), missiles positions are computed from it
+        self.time = 0
+
+        self.missiles = []
+        self.explosions = []
+        self.targets = []
+        self.bonuses = []
+        self.cosmetics = []
+        # Unlinked nodes of the pooled sprites, by key
+        self.pools = {}
+        self.spawnTimestamp = {}
+
+        self.__layers = {}
+        self.__callbacks = {}
+        self.__census = None
+        # Heap of (time, seq, missile), entries of rescheduled missiles are stale
+        self.__arrivals = []
+        self.__arrivalSeq = itertools.count()
+
+    def initLayer(self, spriteClass, parent):
+        self.__layers[spriteClass] = avg.DivNode(parent=parent)
+
+    def getLayer(self, spriteClass):
+        return self.__lookup(self.__layers, spriteClass)
+
+    def watchLayers(self, census):
+        '''Registers the layers with an engine.SceneCensus, cosmetic ones can be shed'''
+        self.__census = census
+        for spriteClass, layer in self.__layers.iteritems():
+            shedder = None
+            if issubclass(spriteClass, CosmeticSprite):
+                shedder = lambda count, spriteClass=spriteClass: self.shed(spriteClass,
+                        count)
+
+            census.watchLayer(spriteClass.__name__, layer, shedder)
+
+    def shed(self, spriteClass, count):
+        '''Removes the count oldest cosmetic sprites of the given class'''
+        victims = self.filter(self.cosmetics, spriteClass)[:count]
+        for sprite in victims:
+            sprite.shed()
+
+        return len(victims)
+
+    def registerCallback(self, spriteClass, cb):
+        self.__callbacks[spriteClass] = cb
+
+    def getCallback(self, spriteClass):
+        return self.__lookup(self.__callbacks, spriteClass)
+
+    def filter(self, objects, subClass):
+        return [o for o in objects if isinstance(o, subClass)]
+
+    def setSpeedMul(self, speedMul):
+        if speedMul == self.speedMul:
+            return
+
+        self.speedMul = speedMul
+        for m in self.missiles:
+            if not m.isExploding():
+                m.setCourse(m.getPos(self.time))
+
+    def scheduleArrival(self, missile, time):
+        heapq.heappush(self.__arrivals, (time, next(self.__arrivalSeq), missile))
+
+    def update(self, dt):
+        self.time += dt
+        Missile.update(self, dt)
+        self.__landArrivals()
+        NukeExplosion.killVictims(self)
+
+    def getSnapshot(self):
+        '''Live game objects as plain containers, see restoreSnapshot()'''
+        return {
+            'difficulty': self.difficulty,
+            'speedMul': self.speedMul,
+            'targets': [t.getSnapshot() for t in self.targets],
+            # Exploding missiles are gone, their explosion is all that matters
+            'missiles': [m.getSnapshot() for m in self.missiles if not m.isExploding()],
+            'explosions': [e.getSnapshot() for e in self.explosions],
+            'bonuses': [b.getSnapshot() for b in self.bonuses],
+        }
+
+    def restoreSnapshot(self, data):
+        '''Recreates the objects of a snapshot, the world is supposed to be empty'''
+        self.difficulty = data['difficulty']
+        self.setSpeedMul(data['speedMul'])
+
+        for obj in data['targets']:
+            SNAPSHOT_CLASSES[obj['class']].fromSnapshot(self, obj)
+
+        for obj in data['missiles']:
+            SNAPSHOT_CLASSES[obj['class']].fromSnapshot(self, obj)
+
+        for obj in data['explosions']:
+            SNAPSHOT_CLASSES[obj['class']].fromSnapshot(self, obj)
+
+        for obj in data['bonuses']:
+            SNAPSHOT_CLASSES[obj['class']].fromSnapshot(self, obj)
+
+    def clear(self):
+        '''
+        Drops all the game objects at once. Their anims and timers are stopped
+        without calling back, then each layer is replaced by an empty one and the
+        registries are emptied, instead of unlinking and unregistering the
+        objects one by one
+        '''
+        for objects in (self.targets, self.missiles, self.explosions, self.bonuses,
+                self.cosmetics):
+            for obj in objects:
+                obj.halt()
+
+        for spriteClass, layer in self.__layers.items():
+            parent = layer.getParent()
+            index = parent.indexOf(layer)
+            layer.unlink(True)
+            self.__layers[spriteClass] = avg.DivNode()
+            parent.insertChild(self.__layers[spriteClass], index)
+
+        if self.__census is not None:
+            self.watchLayers(self.__census)
+
+        self.missiles = []
+        self.explosions = []
+        self.targets = []
+        self.bonuses = []
+        self.cosmetics = []
+        self.status = GameStatus()
+        self.__arrivals = []
+
+    def countObjects(self):
+        '''Live objects, layer nodes and scheduled arrivals, nothing after clear()'''
+        return (len(self.missiles) + len(self.explosions) + len(self.targets) +
+                len(self.bonuses) + len(self.cosmetics) + len(self.__arrivals) +
+                sum(layer.getNumChildren() for layer in self.__layers.values()))
+
+    def __landArrivals(self):
+        while self.__arrivals and self.__arrivals[0][0] <= self.time:
+            time, seq, missile = heapq.heappop(self.__arrivals)
+            if missile.arrivalTime == time and not missile.isExploding():
+                missile.arrive()
+
+    def __lookup(self, registry, spriteClass):
+        for cls in spriteClass.__mro__:
+            if cls in registry:
+                return registry[cls]
+
+        return None
+
+
 class LayeredSprite(object):
-    layer = None
+    def __init__(self, world):
+        self.world = world
+        self.layer = world.getLayer(self.__class__)
 
-    @classmethod
-    def initLayer(cls, parent):
-        cls.layer = avg.DivNode(parent=parent)
+    def halt(self):
+        '''Stops anims and timers, leaving the nodes and registries to World.clear()'''
+        pass
 
 
 class Explosion(LayeredSprite):
-    objects = []
-    cb = None
-
-    def __init__(self, pos):
-        self._node = avg.CircleNode(pos=pos, r=engine.norm.r(20), fillcolor=self.COLOR,
+    def __init__(self, world, pos, sound=True, notify=True, phase=None):
+        '''phase: (radius, fill opacity, elapsed time) to resume the explosion from'''
+        super(Explosion, self).__init__(world)
+        self._node = avg.CircleNode(pos=pos, r=world.norm.r(20), fillcolor=self.COLOR,
                 opacity=0, fillopacity=1, parent=self.layer)
 
-        targetRadius = engine.norm.r(self.RADIUS)
-        if app.instance.mainDiv.difficultyLevel == 2:
+        targetRadius = world.norm.r(self.RADIUS)
+        if world.difficulty == 2:
             targetRadius *= 0.8
 
-        diman = avg.EaseInOutAnim(self._node, 'r', self.DURATION, 1,
-                targetRadius, self.DURATION / 3, self.DURATION * 2 / 3)
-        opaan = avg.EaseInOutAnim(self._node, 'fillopacity', self.DURATION, 1, 0,
-                self.DURATION, 0)
+        if phase is None:
+            self._startTime = engine.clock.getTime()
+            diman = avg.EaseInOutAnim(self._node, 'r', self.DURATION, 1,
+                    targetRadius, self.DURATION / 3, self.DURATION * 2 / 3)
+            opaan = avg.EaseInOutAnim(self._node, 'fillopacity', self.DURATION, 1, 0,
+                    self.DURATION, 0)
+        else:
+            r, fillopacity, elapsed = phase
+            self._startTime = engine.clock.getTime() - elapsed
+            remaining = max(self.DURATION - elapsed, 1)
+            diman = avg.LinearAnim(self._node, 'r', remaining, r, targetRadius)
+            opaan = avg.LinearAnim(self._node, 'fillopacity', remaining, fillopacity, 0)
         self.__anim = avg.ParallelAnim((diman, opaan), None, self._cleanup)
         self.__anim.start()
 
-        if self.SOUND:
-            engine.SoundManager.play(random.choice(self.SOUND), randomVolume=True)
+        maxSounds = engine.quality.maxExplosionSounds
+        if sound and self.SOUND and (maxSounds is None or
+                len(world.filter(world.explosions, self.__class__)) < maxSounds):
+            world.sounds.play(random.choice(self.SOUND), randomVolume=True)
 
-        self.objects.append(self)
+        world.explosions.append(self)
+        self._statusChanged(1)
+        recorder.flight.record(recorder.EXPLOSION, self.__class__.__name__, pos[0], pos[1])
 
-        if self.cb is not None:
-            self.cb()
+        cb = world.getCallback(self.__class__)
+        if notify and cb is not None:
+            cb()
+
+    def _statusChanged(self, delta):
+        pass
+
+    def getSnapshot(self):
+        return {
+            'class': self.__class__.__name__,
+            'pos': pointTuple(self._node.pos),
+            'r': self._node.r,
+            'fillopacity': self._node.fillopacity,
+            'elapsed': engine.clock.getTime() - self._startTime,
+        }
+
+    @classmethod
+    def fromSnapshot(cls, world, data):
+        return cls(world, data['pos'], sound=False, notify=False,
+                phase=(data['r'], data['fillopacity'], data['elapsed']))
+
+    def halt(self):
+        self.__anim.setStopCallback(None)
+        self.__anim.abort()
 
     def _cleanup(self):
         self.__anim.abort()
         del self.__anim
         self._node.unlink(True)
-        self.objects.remove(self)
-
-    @classmethod
-    def filter(cls, subClass):
-        return [t for t in cls.objects if isinstance(t, subClass)]
-
-    @classmethod
-    def registerCallback(cls, cb):
-        cls.cb = cb
+        self.world.explosions.remove(self)
+        self._statusChanged(-1)
 
 
 class EmpExplosion(Explosion):
@@ -103,18 +349,32 @@ class EmpExplosion(Explosion):
     COLOR = consts.COLOR_BLUE
     SOUND = ['emp.ogg']
 
-    def __init__(self, pos):
+    def __init__(self, world, pos, **kwargs):
         self.hits = 0
-        super(EmpExplosion, self).__init__(pos)
+        super(EmpExplosion, self).__init__(world, pos, **kwargs)
 
     def addHit(self):
         self.hits += 1
 
+    def getSnapshot(self):
+        data = super(EmpExplosion, self).getSnapshot()
+        data['hits'] = self.hits
+        return data
+
+    @classmethod
+    def fromSnapshot(cls, world, data):
+        explosion = super(EmpExplosion, cls).fromSnapshot(world, data)
+        explosion.hits = data['hits']
+        return explosion
+
+    def _statusChanged(self, delta):
+        self.world.status.activeEmps += delta
+
     def _cleanup(self):
         if self.hits == consts.GREAT_HITS:
-            AmmoBonus(self._node.pos, 10000)
+            AmmoBonus(self.world, self._node.pos, 10000)
         elif self.hits == consts.NUKE_HITS:
-            NukeBonus(self._node.pos, 20000)
+            NukeBonus(self.world, self._node.pos, 20000)
 
         super(EmpExplosion, self)._cleanup()
 
@@ -127,6 +387,43 @@ class NukeExplosion(EmpExplosion):
     def addHit(self):
         pass
 
+    @classmethod
+    def killVictims(cls, world):
+        '''
+        Mass-kill path: the enemies caught by the nukes are resolved in a single
+        pass, with capped secondary explosions, a single cloud flash and one
+        aggregated score update
+        '''
+        nukes = [(e._node.pos, e._node.r ** 2)
+                for e in world.filter(world.explosions, NukeExplosion)]
+        if not nukes:
+            return
+
+        victims = []
+        for enemy in world.filter(world.missiles, Enemy):
+            if enemy.isExploding():
+                continue
+
+            pos = enemy.traj.pos2
+            for center, sqr in nukes:
+                if sqdist(center, pos) < sqr:
+                    victims.append(enemy)
+                    break
+
+        if not victims:
+            return
+
+        for i, enemy in enumerate(victims):
+            enemy.explode(enemy.traj.pos2,
+                    visual=i < consts.NUKE_MAX_SECONDARY_EXPLOSIONS,
+                    sound=i < consts.NUKE_MAX_SECONDARY_SOUNDS, notify=False)
+
+        cb = world.getCallback(EnemyExplosion)
+        if cb is not None:
+            cb()
+
+        world.game.enemiesKilled(len(victims))
+
 
 class EnemyExplosion(Explosion):
     DURATION = 1000
@@ -136,38 +433,131 @@ class EnemyExplosion(Explosion):
             'enemy_exp4.ogg', 'enemy_exp5.ogg']
 
 
-class TouchFeedback(LayeredSprite):
-    def __init__(self, pos, color):
-        self.__node = avg.CircleNode(color=color, strokewidth=2,
-                parent=self.layer, r=engine.norm.r(10), pos=pos)
+class CosmeticSprite(LayeredSprite):
+    '''
+    Purely visual sprite, living as long as its animation. The oldest ones get
+    shed when their layer runs over its node budget (see World.shed())
+    '''
+    def __init__(self, world):
+        super(CosmeticSprite, self).__init__(world)
+        self.__node = None
+        self.__anim = None
+
+    def halt(self):
+        if self.__anim is not None:
+            self.__anim.setStopCallback(None)
+            self.__anim.abort()
+            self.__anim = None
 
-        diman = avg.LinearAnim(self.__node, 'r', 200, engine.norm.r(10), engine.norm.r(20))
-        opaan = avg.LinearAnim(self.__node, 'opacity', 200, 1, 0)
-        self.__anim = avg.ParallelAnim((diman, opaan), None, self.__cleanup)
+    def shed(self):
+        anim = self.__anim
+        if anim is not None:
+            anim.abort()
+
+        self.__cleanup()
+
+    def _animate(self, node, anims):
+        self.__node = node
+        self.__anim = avg.ParallelAnim(anims, None, self.__cleanup)
         self.__anim.start()
+        self.world.cosmetics.append(self)
 
     def __cleanup(self):
-        del self.__anim
-        self.__node.unlink(True)
+        # Either the animation ended or it has been shed
+        if self.__node is None:
+            return
 
+        self.world.cosmetics.remove(self)
+        self.__anim = None
+        self._release(self.__node)
+        self.__node = None
+
+    def _release(self, node):
+        node.unlink(True)
+
+
+class TouchFeedback(CosmeticSprite):
+    def __init__(self, world, pos, color):
+        super(TouchFeedback, self).__init__(world)
+        if not engine.quality.touchFeedback:
+            return
 
-class TextFeedback(LayeredSprite):
+        node = avg.CircleNode(color=color, strokewidth=2,
+                parent=self.layer, r=world.norm.r(10), pos=pos)
+
+        diman = avg.LinearAnim(node, 'r', 200, world.norm.r(10), world.norm.r(20))
+        opaan = avg.LinearAnim(node, 'opacity', 200, 1, 0)
+        self._animate(node, (diman, opaan))
+
+
+class TextFeedback(CosmeticSprite):
+    '''
+    Popup message, rendered once at its final size (see glyphs.RenderedText)
+    and animated by size, opacity and position only. Nodes are pooled by
+    message and at most TEXT_FEEDBACK_MAX_SAME popups of a message are shown,
+    the oldest one is recycled beyond that
+    '''
     TRANSITION_TIME = 500
-    def __init__(self, pos, text, color):
-        self.__node = widgets.GameWordsNode(text=text, parent=self.layer,
-                pos=pos, fontsize=30, color=color, alignment='center')
-
-        diman = avg.LinearAnim(self.__node, 'fontsize', self.TRANSITION_TIME,
-                engine.norm.y(30), engine.norm.y(60))
-        opaan = avg.LinearAnim(self.__node, 'opacity', self.TRANSITION_TIME, 1, 0)
-        offsan = avg.LinearAnim(self.__node, 'pos',
-                self.TRANSITION_TIME, pos, pos - engine.norm.p(Point2D(70, 70)))
-        self.__anim = avg.ParallelAnim((diman, opaan, offsan), None, self.__cleanup)
-        self.__anim.start()
+    FONTSIZE = 30
+    # Grows from FONTSIZE to FONTSIZE * SCALE
+    SCALE = 2
+    MESSAGES = ('GREAT!', '** AWESOME **', 'BUSTED!', 'AMMO DEPLETED!', 'Low ammo!')
+
+    def __init__(self, world, pos, text, color):
+        super(TextFeedback, self).__init__(world)
+        self.text = text
+        self.__pooled = False
+        if not engine.quality.textFeedback:
+            return
 
-    def __cleanup(self):
-        del self.__anim
-        self.__node.unlink(True)
+        pos = Point2D(pos)
+        endPos = pos - world.norm.p(Point2D(70, 70))
+        rendered = glyphs.atlas.getText(text, world.norm.y(self.FONTSIZE * self.SCALE))
+        if rendered is None:
+            node = widgets.GlyphText(text=text, parent=self.layer,
+                    pos=pos, fontsize=self.FONTSIZE, color=color, alignment='center')
+
+            diman = avg.LinearAnim(node, 'scale', self.TRANSITION_TIME, 1, self.SCALE)
+            opaan = avg.LinearAnim(node, 'opacity', self.TRANSITION_TIME, 1, 0)
+            offsan = avg.LinearAnim(node, 'pos', self.TRANSITION_TIME, pos, endPos)
+            self._animate(node, (diman, opaan, offsan))
+            return
+
+        same = [s for s in world.cosmetics if isinstance(s, TextFeedback) and
+                s.text == text]
+        if len(same) >= consts.TEXT_FEEDBACK_MAX_SAME:
+            same[0].shed()
+
+        pool = world.pools.setdefault((TextFeedback, text), [])
+        if pool:
+            node = pool.pop()
+        else:
+            node = avg.ImageNode(href=rendered.href, sensitive=False)
+        node.intensity = glyphs.getIntensity(color)
+        self.layer.appendChild(node)
+        self.__pooled = True
+
+        # Centered on pos, as the words nodes
+        startSize = rendered.size / self.SCALE
+        diman = avg.LinearAnim(node, 'size', self.TRANSITION_TIME, startSize,
+                rendered.size)
+        opaan = avg.LinearAnim(node, 'opacity', self.TRANSITION_TIME, 1, 0)
+        offsan = avg.LinearAnim(node, 'pos', self.TRANSITION_TIME,
+                pos - Point2D(startSize.x / 2, 0), endPos - Point2D(rendered.size.x / 2, 0))
+        self._animate(node, (diman, opaan, offsan))
+
+    @classmethod
+    def preload(cls, norm):
+        '''Renders the known messages ahead of their first popup'''
+        for text in cls.MESSAGES:
+            glyphs.atlas.getText(text, norm.y(cls.FONTSIZE * cls.SCALE))
+
+    def _release(self, node):
+        if self.__pooled:
+            node.unlink(False)
+            self.world.pools[(TextFeedback, self.text)].append(node)
+        else:
+            super(TextFeedback, self)._release(node)
 
 
 class Bonus(LayeredSprite):
@@ -176,36 +566,57 @@ class Bonus(LayeredSprite):
     TRANSITION_ZOOM = 18
     DROP_RADIUS_SQ = 900
 
-    spawnTimestamp = {}
-
     STATE_BUSY = 'STATE_BUSY'
     STATE_READY = 'STATE_READY'
     STATE_DRAGGING = 'STATE_DRAGGING'
 
-    def __init__(self, pos, icon, waitTime):
-        if (self.__class__ in self.spawnTimestamp and
-                player.getFrameTime() - self.spawnTimestamp[self.__class__] < waitTime):
+    def __init__(self, world, pos, icon, waitTime):
+        super(Bonus, self).__init__(world)
+        spawnTimestamp = world.spawnTimestamp
+        if (self.__class__ in spawnTimestamp and
+                engine.clock.getTime() - spawnTimestamp[self.__class__] < waitTime):
             return
         else:
-            self.spawnTimestamp[self.__class__] = player.getFrameTime()
+            spawnTimestamp[self.__class__] = engine.clock.getTime()
 
         self._state = self.STATE_BUSY
-        self._tmr = player.setInterval(100, self.__tick)
+        self._tmr = engine.clock.setInterval(100, self.__tick)
         self._remainingTicks = consts.BONUS_AVAILABILITY_TICKS
 
         self._node = widgets.RIImage(href=icon, pos=pos, parent=self.layer)
+        # Normalised size, the media size depends on the image being pre-scaled
+        size = Point2D(self._node.size)
         diman = avg.LinearAnim(self._node, 'size', self.TRANSITION_TIME,
-                self._node.getMediaSize() * self.TRANSITION_ZOOM,
-                self._node.getMediaSize())
+                size * self.TRANSITION_ZOOM, size)
         opaan = avg.LinearAnim(self._node, 'opacity',
                 self.TRANSITION_TIME, 0, self.OPACITY)
         offsan = avg.LinearAnim(self._node, 'pos', self.TRANSITION_TIME,
-                Point2D(pos) - self._node.getMediaSize() * self.TRANSITION_ZOOM / 2, pos)
+                Point2D(pos) - size * self.TRANSITION_ZOOM / 2, pos)
         self._anim = avg.ParallelAnim((diman, opaan, offsan), None, self.__ready)
         self._anim.start()
         self.__cursorid = None
+        world.bonuses.append(self)
 
-        engine.SoundManager.play('bonus_alert.ogg')
+        world.sounds.play('bonus_alert.ogg')
+
+    def isReady(self):
+        return self._state == self.STATE_READY
+
+    def getSnapshot(self):
+        return {
+            'class': self.__class__.__name__,
+            'pos': pointTuple(self._node.pos),
+            'ticks': self._remainingTicks,
+        }
+
+    @classmethod
+    def fromSnapshot(cls, world, data):
+        bonus = cls(world, data['pos'])
+        bonus._remainingTicks = data['ticks']
+        return bonus
+
+    def getCenter(self):
+        return self._node.pos + self._node.size / 2
 
     def _trigger(self):
         return False
@@ -228,12 +639,15 @@ class Bonus(LayeredSprite):
         if not self._trigger():
             self._state = self.STATE_READY
         else:
-            engine.SoundManager.play('bonus_drop.ogg')
+            self.world.sounds.play('bonus_drop.ogg')
+            self.world.game.bonusDeployed(self)
 
     def __startDrag(self, event):
         if self._state != self.STATE_DRAGGING:
-            event.contact.subscribe(avg.Contact.CURSOR_MOTION, self.__move)
-            event.contact.subscribe(avg.Contact.CURSOR_UP, self.__release)
+            event.contact.subscribe(avg.Contact.CURSOR_MOTION,
+                    engine.motion.coalesce(self.__move))
+            event.contact.subscribe(avg.Contact.CURSOR_UP,
+                    engine.motion.release(self.__release))
             self._state = self.STATE_DRAGGING
             self.__handlePos = event.pos - self._node.pos
 
@@ -261,19 +675,28 @@ class Bonus(LayeredSprite):
         else:
             self._node.opacity = 0
 
+    def halt(self):
+        self._state = self.STATE_BUSY
+        engine.clock.clearInterval(self._tmr)
+        if self._anim:
+            self._anim.setStopCallback(None)
+            self._anim.abort()
+            self._anim = None
+
     def _destroy(self):
         self._state = self.STATE_BUSY
-        player.clearInterval(self._tmr)
+        engine.clock.clearInterval(self._tmr)
         if self._anim:
             self._anim.abort()
             del self._anim
             self._anim = None
         self._node.unlink(True)
+        self.world.bonuses.remove(self)
 
 
 class NukeBonus(Bonus):
-    def __init__(self, pos, waitTime=0):
-        super(NukeBonus, self).__init__(pos, 'bns_nuke.png', waitTime)
+    def __init__(self, world, pos, waitTime=0):
+        super(NukeBonus, self).__init__(world, pos, 'bns_nuke.png', waitTime)
         self.__targetTurret = None
 
     def _trigger(self):
@@ -281,7 +704,7 @@ class NukeBonus(Bonus):
             self.__turret.loadNuke()
             self._destroy()
 
-        for t in Target.filter(Turret):
+        for t in self.world.filter(self.world.targets, Turret):
             if (sqdist(self._node.pos + self._node.size / 2,
                 t.getHitPos()) < self.DROP_RADIUS_SQ):
                     self.__turret = t
@@ -290,15 +713,15 @@ class NukeBonus(Bonus):
 
 
 class AmmoBonus(Bonus):
-    def __init__(self, pos, waitTime=0):
-        super(AmmoBonus, self).__init__(pos, 'bns_ammo.png', waitTime)
+    def __init__(self, world, pos, waitTime=0):
+        super(AmmoBonus, self).__init__(world, pos, 'bns_ammo.png', waitTime)
 
     def _trigger(self):
         def loadAmmo():
             self.__turret.rechargeAmmo()
             self._destroy()
 
-        for t in Target.filter(Turret):
+        for t in self.world.filter(self.world.targets, Turret):
             if (sqdist(self._node.pos + self._node.size / 2,
                 t.getHitPos()) < self.DROP_RADIUS_SQ):
                     self.__turret = t
@@ -308,29 +731,78 @@ class AmmoBonus(Bonus):
 
 # Abstract
 class Missile(LayeredSprite):
-    objects = []
-    speedMul = 1
+    latencyTrace = None
     TRAIL_THICKNESS = 1
-    def __init__(self, initPoint, targetPoint):
+    def __init__(self, world, initPoint, targetPoint):
+        super(Missile, self).__init__(world)
         self.initPoint = initPoint
         self.targetPoint = targetPoint
         self.__isExploding = False
-        self.__lastSpeedVector = Point2D(0, 0)
+        self.__origin = None
+        self.__originTime = 0
+        self.velocity = Point2D(0, 0)
+        self.arrivalTime = None
 
         self.traj = avg.LineNode(pos1=self.initPoint, pos2=self.initPoint,
-                color=self.COLOR, strokewidth=self.TRAIL_THICKNESS, parent=self.layer)
+                color=self.COLOR,
+                strokewidth=self.TRAIL_THICKNESS * engine.quality.trailScale,
+                parent=self.layer)
 
         self.nominalSpeedVec = ((self.targetPoint - self.initPoint).getNormalized() *
-                engine.norm.r(random.uniform(*self.speedRange)) / consts.DELTAT_NORM_FACTOR)
+                world.norm.r(random.uniform(*self.speedRange)) / consts.DELTAT_NORM_FACTOR)
         self.__fade = None
-        self.objects.append(self)
+        world.missiles.append(self)
+        self.setCourse(initPoint)
+        self._statusChanged(1)
+        recorder.flight.record(recorder.SPAWN, self.__class__.__name__,
+                initPoint.x, initPoint.y)
 
-    def explode(self, pos):
+    def explode(self, pos, visual=True, sound=True, notify=True):
         if not self.__isExploding:
             self.__isExploding = True
             self.__fade = avg.Anim.fadeOut(
                     self.traj, self.explosionClass.DURATION / 2, self.__cleanup)
-            self.explosionClass(pos)
+            if visual:
+                self.explosionClass(self.world, pos, sound=sound, notify=notify)
+
+    def isExploding(self):
+        return self.__isExploding
+
+    def setCourse(self, pos):
+        '''
+        Heads to the target from pos at the current speed: the position is then a
+        function of the world time and the arrival is scheduled in advance
+        '''
+        self.__origin = Point2D(pos)
+        self.__originTime = self.world.time
+        self.velocity = self.speedVector(1)
+        distance = (self.targetPoint - self.__origin).getNorm()
+        self.arrivalTime = self.__originTime + distance / self.velocity.getNorm()
+        self.world.scheduleArrival(self, self.arrivalTime)
+
+    def getPos(self, time):
+        if time >= self.arrivalTime:
+            return self.targetPoint
+
+        return self.__origin + self.velocity * (time - self.__originTime)
+
+    def arrive(self):
+        self.explode(self.targetPoint)
+
+    def getSnapshot(self):
+        return {
+            'class': self.__class__.__name__,
+            'init': pointTuple(self.initPoint),
+            'target': pointTuple(self.targetPoint),
+            'pos': pointTuple(self.traj.pos2),
+            'speed': pointTuple(self.nominalSpeedVec),
+        }
+
+    def resume(self, data):
+        '''Moves the missile to where it was in the snapshot'''
+        self.traj.pos2 = data['pos']
+        self.nominalSpeedVec = Point2D(data['speed'])
+        self.setCourse(self.traj.pos2)
 
     def destroy(self):
         if self.__fade:
@@ -339,42 +811,51 @@ class Missile(LayeredSprite):
 
         self.__cleanup()
 
+    def halt(self):
+        if self.__fade:
+            self.__fade.setStopCallback(None)
+            self.__fade.abort()
+            self.__fade = None
+        self.arrivalTime = None
+
     def collisionCheck(self, dt):
         pass
 
     def getSpeedFactor(self):
         return 1
 
+    def _statusChanged(self, delta):
+        pass
+
     def speedVector(self, dt):
         return (
                 self.nominalSpeedVec *
                 self.getSpeedFactor() *
-                self.speedMul *
+                self.world.speedMul *
                 dt
             )
 
     def __cleanup(self):
         del self.__fade
         self.traj.unlink(True)
-        self.objects.remove(self)
+        self.world.missiles.remove(self)
+        self._statusChanged(-1)
 
     def __repr__(self):
         return '%s %s -> (%d, %d) v=%.2f' % (self.__class__.__name__,
                 self.initPoint,
                 int(self.traj.pos2.x), int(self.traj.pos2.y),
-                math.sqrt(self.__lastSpeedVector.x ** 2 + self.__lastSpeedVector.y ** 2),
+                self.velocity.getNorm(),
                 )
 
     @classmethod
-    def filter(cls, subClass):
-        return [t for t in cls.objects if isinstance(t, subClass)]
-
-    @classmethod
-    def update(cls, dt):
-        for m in cls.objects:
+    def update(cls, world, dt):
+        for m in world.missiles:
             if not m.__isExploding:
-                m.__lastSpeedVector = m.speedVector(dt)
-                m.traj.pos2 += m.__lastSpeedVector
+                m.traj.pos2 = m.getPos(world.time)
+                if m.latencyTrace is not None:
+                    latency.tracker.trailDrawn(m.latencyTrace)
+                    m.latencyTrace = None
                 m.collisionCheck(dt)
 
 
@@ -383,128 +864,198 @@ class Enemy(Missile):
     explosionClass = EnemyExplosion
     COLOR = consts.COLOR_RED
 
-    def __init__(self, initPoint, targetObj, level):
+    def __init__(self, world, initPoint, targetObj, level):
         self.__level = level
         # TODO: dangling reference
         self.__targetObj = targetObj
-        super(Enemy, self).__init__(initPoint, targetObj.getHitPos())
+        super(Enemy, self).__init__(world, initPoint, targetObj.getHitPos())
+
+    def getSnapshot(self):
+        data = super(Enemy, self).getSnapshot()
+        data['level'] = self.__level
+        if self.__targetObj.isDead:
+            data['targetIndex'] = None
+        else:
+            data['targetIndex'] = self.world.targets.index(self.__targetObj)
+        return data
+
+    @classmethod
+    def fromSnapshot(cls, world, data):
+        if data['targetIndex'] is None:
+            target = Wreck(Point2D(data['target']))
+        else:
+            target = world.targets[data['targetIndex']]
+
+        enemy = cls(world, Point2D(data['init']), target, data['level'])
+        enemy.resume(data)
+        return enemy
 
     def collisionCheck(self, dt):
-        # Check if the enemy enters an EMP shockwave
-        for exp in Explosion.filter(EmpExplosion):
+        # Check if the enemy enters an EMP shockwave (nukes are resolved in bulk
+        # by NukeExplosion.killVictims())
+        for exp in self.world.filter(self.world.explosions, EmpExplosion):
+            if isinstance(exp, NukeExplosion):
+                continue
             if sqdist(exp._node.pos, self.traj.pos2) < exp._node.r ** 2:
                     exp.addHit()
                     if exp.hits == consts.GREAT_HITS:
-                        TextFeedback(exp._node.pos, 'GREAT!', consts.COLOR_BLUE)
+                        TextFeedback(self.world, exp._node.pos, 'GREAT!',
+                                consts.COLOR_BLUE)
                     elif exp.hits == consts.NUKE_HITS:
-                        TextFeedback(exp._node.pos, '** AWESOME **', consts.COLOR_BLUE)
+                        TextFeedback(self.world, exp._node.pos, '** AWESOME **',
+                                consts.COLOR_BLUE)
                     self.explode(self.traj.pos2)
-                    app.instance.mainDiv.sequencer.getState('game').enemyDestroyed(self)
+                    self.world.game.enemyDestroyed(self)
 
-        # Check if the enemy reached its destination
-        v = self.speedVector(dt)
-        if sqdist(self.traj.pos2, self.targetPoint) <= (v.x ** 2 + v.y ** 2):
-            self.explode(self.targetPoint)
-            app.instance.mainDiv.sequencer.getState('game').enemyDestroyed(self, self.__targetObj)
+    def arrive(self):
+        super(Enemy, self).arrive()
+        self.world.game.enemyDestroyed(self, self.__targetObj)
 
     def getSpeedFactor(self):
         return 1 + self.__level * consts.WAVE_ENEMY_SPEED_INCREASE_FACTOR
 
+    def _statusChanged(self, delta):
+        self.world.status.enemiesAlive += delta
+
 
 class TurretMissile(Missile):
     speedRange = [7, 8]
     explosionClass = EmpExplosion
     COLOR = consts.COLOR_BLUE
 
-    def __init__(self, initPoint, targetPoint, nuke=False):
+    def __init__(self, world, initPoint, targetPoint, nuke=False):
         self.__isNuke = nuke
         if nuke:
             self.speedRange = [3, 3]
             self.TRAIL_THICKNESS = 4
             self.explosionClass = NukeExplosion
 
-        super(TurretMissile, self).__init__(initPoint, targetPoint)
+        super(TurretMissile, self).__init__(world, initPoint, targetPoint)
+        latency.tracker.attach(self)
 
-    def collisionCheck(self, dt):
-        v = self.speedVector(dt)
-        if sqdist(self.traj.pos2, self.targetPoint) <= (v.x ** 2 + v.y ** 2):
-            self.explode(self.targetPoint)
+    def getSnapshot(self):
+        data = super(TurretMissile, self).getSnapshot()
+        data['nuke'] = self.__isNuke
+        return data
+
+    @classmethod
+    def fromSnapshot(cls, world, data):
+        missile = cls(world, Point2D(data['init']), Point2D(data['target']),
+                nuke=data['nuke'])
+        missile.resume(data)
+        return missile
+
+    def _statusChanged(self, delta):
+        self.world.status.turretMissiles += delta
 
 
 class Target(LayeredSprite):
-    objects = []
     defaultLives = 3
-    def __init__(self, slot, node):
+    def __init__(self, world, slot, node):
+        super(Target, self).__init__(world)
         self.layer.appendChild(node)
         node.pos = slot
         self.isDead = False
         self.lives = self.defaultLives
-        self.objects.append(self)
+        world.targets.append(self)
+        self._statusChanged(1)
 
     def hit(self):
         self.lives -= 1
         if self.lives == 0:
             self.destroy()
-            engine.SoundManager.play('target_destroy.ogg', randomVolume=True)
+            self.world.sounds.play('target_destroy.ogg', randomVolume=True)
             return True
         else:
-            engine.SoundManager.play('target_hit.ogg', randomVolume=True)
+            self.world.sounds.play('target_hit.ogg', randomVolume=True)
             return False
 
+    def halt(self):
+        self.isDead = True
+
     def destroy(self):
         self.isDead = True
         self._node.unlink(True)
         self.base.unlink(True)
-        self.objects.remove(self)
+        self.world.targets.remove(self)
+        self._statusChanged(-1)
+
+    def _statusChanged(self, delta):
+        pass
 
     def getHitPos(self):
-        return self._node.pos + engine.norm.p(Point2D(10, 10), diagNorm=True)
+        return self._node.pos + self.world.norm.p(Point2D(10, 10), diagNorm=True)
 
-    def __repr__(self):
-        return '%s %s' % (self.__class__.__name__, self._node.pos)
+    def getSnapshot(self):
+        return {
+            'class': self.__class__.__name__,
+            'pos': pointTuple(self._node.pos),
+            'lives': self.lives,
+        }
 
     @classmethod
-    def filter(cls, subClass):
-        return [t for t in cls.objects if isinstance(t, subClass)]
+    def fromSnapshot(cls, world, data):
+        target = cls(world, Point2D(data['pos']))
+        target.lives = data['lives']
+        return target
+
+    def __repr__(self):
+        return '%s %s' % (self.__class__.__name__, self._node.pos)
 
 
 class Turret(Target):
     LIVES_COLORS = {3: '4444ff', 2: 'aa44cc', 1: 'ff4444', 0: 'ff1111'}
-    def __init__(self, slot, ammo):
-        self._node = avg.DivNode()
-        self.base = avg.PolygonNode(
-                pos=engine.norm.sp(((10, 0), (0, 20), (20, 20)), diagNorm=True),
-                fillopacity=1, fillcolor=self.LIVES_COLORS[self.defaultLives],
-                opacity=0, parent=self._node)
-        self.__ammoGauge = widgets.Gauge(consts.COLOR_BLUE,
-                widgets.Gauge.LAYOUT_HORIZONTAL,
-                pos=engine.norm.p((0, 25), diagNorm=True),
-                size=engine.norm.p((20, 5), diagNorm=True),
-                opacity=0.5, parent=self._node)
-
-        self.nukeAlert = widgets.RIImage(href='nuke_alert.png',
-                pos=engine.norm.p((0, 35), diagNorm=True),
-                opacity=0, parent=self._node)
+    def __init__(self, world, slot, ammo, nodes=None):
+        if nodes is None:
+            nodes = self.createNodes(world.norm)
+        self._node, self.base, self.__ammoGauge, self.nukeAlert = nodes
 
         self.__ammo = int(ammo)
         self.__initialAmmo = self.__ammo
+        world.status.ammo += self.__ammo
         self.__hasNuke = False
         self.__nukeAnim = None
-        super(Turret, self).__init__(slot, self._node)
+        super(Turret, self).__init__(world, slot, self._node)
+
+    @classmethod
+    def createNodes(cls, norm):
+        '''Unlinked node tree of a turret, see WavePlan'''
+        node = avg.DivNode()
+        base = avg.PolygonNode(
+                pos=norm.sp(((10, 0), (0, 20), (20, 20)), diagNorm=True),
+                fillopacity=1, fillcolor=cls.LIVES_COLORS[cls.defaultLives],
+                opacity=0, parent=node)
+        ammoGauge = widgets.Gauge(consts.COLOR_BLUE,
+                widgets.Gauge.LAYOUT_HORIZONTAL,
+                pos=norm.p((0, 25), diagNorm=True),
+                size=norm.p((20, 5), diagNorm=True),
+                opacity=0.5, parent=node)
+
+        nukeAlert = widgets.RIImage(href='nuke_alert.png',
+                pos=norm.p((0, 35), diagNorm=True),
+                opacity=0, parent=node)
+
+        return node, base, ammoGauge, nukeAlert
 
     def fire(self, pos):
+        latency.tracker.mark('fire')
         if self.__hasNuke:
-            TurretMissile(self._node.pos + engine.norm.p((10, 0), diagNorm=True),
+            TurretMissile(self.world,
+                    self._node.pos + self.world.norm.p((10, 0), diagNorm=True),
                     pos, nuke=True)
             self.__hasNuke = False
-            app.instance.mainDiv.sequencer.getState('game').nukeFired = True
-            engine.SoundManager.play('nuke_launch.ogg')
+            self.world.game.nukeFired = True
+            self.world.sounds.play('nuke_launch.ogg')
+            latency.tracker.mark('sound')
         else:
             if self.__ammo > 0:
                 self.__ammo -= 1
+                self.world.status.ammo -= 1
                 self.__updateGauge()
-                TurretMissile(self._node.pos + engine.norm.p((10, 0), diagNorm=True), pos)
-                engine.SoundManager.play('missile_launch.ogg', randomVolume=True)
+                TurretMissile(self.world,
+                        self._node.pos + self.world.norm.p((10, 0), diagNorm=True), pos)
+                self.world.sounds.play('missile_launch.ogg', randomVolume=True)
+                latency.tracker.mark('sound')
                 return True
             else:
                 return False
@@ -519,6 +1070,25 @@ class Turret(Target):
     def getAmmo(self):
         return self.__ammo
 
+    def getSnapshot(self):
+        data = super(Turret, self).getSnapshot()
+        data['ammo'] = self.__ammo
+        data['initialAmmo'] = self.__initialAmmo
+        data['nuke'] = self.__hasNuke
+        return data
+
+    @classmethod
+    def fromSnapshot(cls, world, data):
+        turret = cls(world, Point2D(data['pos']), data['initialAmmo'])
+        turret.lives = data['lives']
+        turret.base.fillcolor = cls.LIVES_COLORS[turret.lives]
+        world.status.ammo += data['ammo'] - turret.__ammo
+        turret.__ammo = data['ammo']
+        turret.__updateGauge()
+        if data['nuke']:
+            turret.loadNuke()
+        return turret
+
     def hasAmmo(self):
         return self.__ammo > 0 or self.__hasNuke
 
@@ -532,12 +1102,22 @@ class Turret(Target):
             self.__nukeAnim.setStopCallback(None)
             self.__nukeAnim.abort()
 
+        # Ammo stash sinks with the turret
+        self.world.status.ammo -= self.__ammo
         super(Turret, self).destroy()
 
+    def halt(self):
+        if self.__nukeAnim:
+            self.__nukeAnim.setStopCallback(None)
+            self.__nukeAnim.abort()
+            self.__nukeAnim = None
+        super(Turret, self).halt()
+
     def rechargeAmmo(self):
+        self.world.status.ammo += self.__initialAmmo - self.__ammo
         self.__ammo = self.__initialAmmo
         self.__updateGauge()
-        app.instance.mainDiv.sequencer.getState('game').updateAmmoGauge()
+        self.world.game.updateAmmoGauge()
 
     def loadNuke(self):
         if not self.__hasNuke:
@@ -561,10 +1141,104 @@ class Turret(Target):
 
 class City(Target):
     defaultLives = 1
-    def __init__(self, slot):
-        self._node = avg.DivNode()
-        self.base = avg.PolygonNode(
-                pos=engine.norm.sp(((0, 0), (10, 5), (20, 0), (20, 10), (0, 10)),
+    def __init__(self, world, slot, nodes=None):
+        if nodes is None:
+            nodes = self.createNodes(world.norm)
+        self._node, self.base = nodes
+        super(City, self).__init__(world, slot, self._node)
+
+    @classmethod
+    def createNodes(cls, norm):
+        '''Unlinked node tree of a city, see WavePlan'''
+        node = avg.DivNode()
+        base = avg.PolygonNode(
+                pos=norm.sp(((0, 0), (10, 5), (20, 0), (20, 10), (0, 10)),
                     diagNorm=True),
-                fillopacity=1, fillcolor='8888ff', opacity=0, parent=self._node)
-        super(City, self).__init__(slot, self._node)
+                fillopacity=1, fillcolor='8888ff', opacity=0, parent=node)
+        return node, base
+
+    def _statusChanged(self, delta):
+        self.world.status.citiesAlive += delta
+
+
+class WavePlan(object):
+    '''
+    What a wave needs before it starts: the enemies spawn timeline, the
+    shuffled target slots and the node trees of the targets. It's built in
+    small steps by advance(), so that the next wave can be prepared while the
+    results of the previous one are shown.
+    '''
+    def __init__(self, wave, difficulty, norm=None):
+        self.wave = wave
+        self.difficulty = difficulty
+        self.norm = norm if norm is not None else engine.norm
+        self.nenemies = int(wave * consts.ENEMIES_WAVE_MULT * (1 + difficulty * 0.2))
+        self.initialAmmo = int(self.nenemies * consts.AMMO_ENEMIES_MULT)
+        self.timeline = []
+        # (slot, nodes) pairs
+        self.turrets = []
+        self.cities = []
+        self.__steps = self.__build()
+
+    def matches(self, wave, difficulty):
+        return self.wave == wave and self.difficulty == difficulty
+
+    def isReady(self):
+        return self.__steps is None
+
+    def advance(self, budget=None):
+        '''Builds for about budget ms (None: until done), True when the plan is ready'''
+        start = time.time()
+        while self.__steps is not None:
+            try:
+                next(self.__steps)
+            except StopIteration:
+                self.__steps = None
+                break
+
+            if budget is not None and (time.time() - start) * 1000 >= budget:
+                break
+
+        return self.__steps is None
+
+    def __build(self):
+        avgSpawnTime = consts.WAVE_DURATION * 1000.0 / self.nenemies
+        absJitter = int(avgSpawnTime * consts.ENEMIES_SPAWNER_JITTER_FACTOR)
+        tm = consts.WAVE_PREAMBLE * 1000
+
+        for i in xrange(self.nenemies):
+            self.timeline.append(tm)
+            tm += avgSpawnTime + random.randrange(-absJitter, absJitter)
+
+        logger.info('Avg spawn time: %d Abs jitter: %d' % (avgSpawnTime, absJitter))
+        yield
+
+        norm = self.norm
+        slots = [Point2D(x * norm.x(consts.SLOT_WIDTH), norm.size.y - norm.y(60))
+                    for x in xrange(1,
+                        int(norm.size.x / norm.x(consts.SLOT_WIDTH) + 1))]
+        random.shuffle(slots)
+        yield
+
+        for i in xrange(consts.TURRETS_AMOUNT):
+            self.turrets.append((slots.pop(), Turret.createNodes(norm)))
+            yield
+
+        for c in xrange(consts.CITIES):
+            self.cities.append((slots.pop(), City.createNodes(norm)))
+            yield
+
+
+class Wreck(object):
+    '''Stands for a target destroyed before a snapshot, still aimed by enemies'''
+    isDead = True
+
+    def __init__(self, hitPos):
+        self.__hitPos = hitPos
+
+    def getHitPos(self):
+        return self.__hitPos
+
+
+SNAPSHOT_CLASSES = dict((cls.__name__, cls) for cls in (EmpExplosion, NukeExplosion,
+        EnemyExplosion, AmmoBonus, NukeBonus, Enemy, TurretMissile, Turret, City))
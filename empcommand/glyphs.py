@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import string
+import logging
+
+from libavg import avg, Point2D, player
+
+
+logger = logging.getLogger(__name__)
+
+FONT = 'EMPRetro'
+CHARSET = string.digits + string.ascii_letters + '!?*.,:;-+%/()#\'"'
+
+
+def getIntensity(color):
+    '''Image intensity tinting white glyphs with an html color (eg: ff0000)'''
+    return (int(color[0:2], 16) / 255.0, int(color[2:4], 16) / 255.0,
+            int(color[4:6], 16) / 255.0)
+
+
+class GlyphFace(object):
+    '''
+    Glyphs of a font size, rendered once in white on an offscreen canvas.
+    glyphs maps each character to its (origin, size) in the atlas, texts are
+    composed by cutting quads out of it (see widgets.GlyphText)
+    '''
+    WIDTH = 1024
+    PADDING = 2
+
+    def __init__(self, fontsize, charset=CHARSET):
+        self.fontsize = fontsize
+        self.glyphs = {}
+        self.spaceAdvance = (self.__measure('x x').x - self.__measure('xx').x)
+
+        nodes = []
+        x = y = self.PADDING
+        lineHeight = 0
+        for char in charset:
+            node = self.__createNode(char)
+            size = Point2D(int(node.size.x + 1), int(node.size.y + 1))
+            if x + size.x + self.PADDING > self.WIDTH:
+                x = self.PADDING
+                y += lineHeight + self.PADDING
+                lineHeight = 0
+
+            node.pos = (x, y)
+            nodes.append(node)
+            self.glyphs[char] = (Point2D(x, y), size)
+            lineHeight = max(lineHeight, size.y)
+            x += size.x + self.PADDING
+
+        self.height = max(size.y for origin, size in self.glyphs.values())
+        self.size = Point2D(self.WIDTH, y + lineHeight + self.PADDING)
+
+        canvasId = 'glyphs%d' % fontsize
+        self.href = 'canvas:' + canvasId
+        canvas = player.createCanvas(id=canvasId, size=self.size, autorender=False,
+                handleevents=False)
+        root = canvas.getRootNode()
+        for node in nodes:
+            root.appendChild(node)
+        canvas.render()
+
+        logger.info('Glyph atlas %s: %d glyphs, %dx%d' % (canvasId, len(self.glyphs),
+                self.size.x, self.size.y))
+
+    def hasGlyphs(self, text):
+        return all(char == ' ' or char in self.glyphs for char in text)
+
+    def __createNode(self, text):
+        return avg.WordsNode(font=FONT, fontsize=self.fontsize, text=text,
+                color='ffffff', rawtextmode=True)
+
+    def __measure(self, text):
+        return self.__createNode(text).size
+
+
+class RenderedText(object):
+    '''A whole text rendered once in white on its own canvas, shown by ImageNodes'''
+    def __init__(self, canvasId, text, fontsize):
+        self.text = text
+        self.fontsize = fontsize
+        node = avg.WordsNode(font=FONT, fontsize=fontsize, text=text, color='ffffff',
+                rawtextmode=True)
+        self.size = Point2D(int(node.size.x + 1), int(node.size.y + 1))
+
+        self.href = 'canvas:' + canvasId
+        canvas = player.createCanvas(id=canvasId, size=self.size, autorender=False,
+                handleevents=False)
+        canvas.getRootNode().appendChild(node)
+        canvas.render()
+
+
+class GlyphAtlas(object):
+    '''
+    Glyph faces by font size and rendered texts, built the first time they're
+    requested
+    '''
+    def __init__(self):
+        self.__faces = {}
+        self.__texts = {}
+        self.__supported = None
+
+    def isSupported(self):
+        if self.__supported is None:
+            self.__supported = avg.OffscreenCanvas.isSupported()
+            if not self.__supported:
+                logger.warning('Offscreen canvases not supported, glyph atlas disabled')
+
+        return self.__supported
+
+    def getFace(self, fontsize):
+        '''None when offscreen rendering isn't available'''
+        if not self.isSupported():
+            return None
+
+        fontsize = int(round(fontsize))
+        if fontsize not in self.__faces:
+            self.__faces[fontsize] = GlyphFace(fontsize)
+
+        return self.__faces[fontsize]
+
+    def getText(self, text, fontsize):
+        '''None when offscreen rendering isn't available'''
+        if not self.isSupported():
+            return None
+
+        key = (text, int(round(fontsize)))
+        if key not in self.__texts:
+            self.__texts[key] = RenderedText('text%d' % len(self.__texts), *key)
+
+        return self.__texts[key]
+
+
+atlas = GlyphAtlas()
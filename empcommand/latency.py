@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import time
+import logging
+import collections
+
+from libavg import player
+
+import engine
+import metrics
+import analytics
+
+
+logger = logging.getLogger(__name__)
+
+
+class TouchTrace(object):
+    '''Wall timestamps (ms) of a touch along its way to the screen'''
+    __slots__ = ('stamps',)
+
+    def __init__(self):
+        self.stamps = {}
+
+    def mark(self, stage):
+        self.stamps[stage] = time.time() * 1000
+
+
+class LatencyTracker(object):
+    '''
+    Follows every touch from GameDiv.onCursorDown down to the first frame showing
+    the trail of the EMP missile it fired.
+
+    Stages:
+        dispatch: input event -> start of the frame handling it (realtime clock only)
+        game: onCursorDown -> Game._onTouch
+        fire: Game._onTouch -> Turret.fire
+        missile: Turret.fire -> TurretMissile created
+        sound: TurretMissile created -> missile_launch.ogg played
+        frame: TurretMissile created -> first frame moving its trail
+        present: trail moved -> next frame (previous one presented)
+    '''
+    STAGES = (
+        # name, from, to
+        ('game', 'down', 'game'),
+        ('fire', 'game', 'fire'),
+        ('missile', 'fire', 'missile'),
+        ('sound', 'missile', 'sound'),
+        ('frame', 'missile', 'frame'),
+        ('present', 'frame', 'present'),
+    )
+    GROUPS = (
+        ('input dispatch', ('dispatch',)),
+        ('python handling', ('game', 'fire', 'missile', 'sound')),
+        ('frame pacing', ('frame', 'present')),
+    )
+    BUCKETS = (0.5, 1, 2, 4, 8, 16, 33, 50, 100, 250)
+    SAMPLES = 1000
+
+    def __init__(self, registry):
+        self.current = None
+        self.touches = 0
+        self.__pending = []
+        self.__histograms = {}
+        self.__samples = {}
+
+        for name in ['dispatch'] + [s[0] for s in self.STAGES] + ['total']:
+            self.__histograms[name] = registry.histogram('latency_%s_ms' % name,
+                    'Touch latency, %s stage' % name, self.BUCKETS)
+            self.__samples[name] = collections.deque(maxlen=self.SAMPLES)
+
+    def begin(self, event):
+        self.current = TouchTrace()
+        self.current.mark('down')
+
+        when = getattr(event, 'when', None)
+        if when is not None and isinstance(engine.clock, engine.RealtimeClock):
+            self.__observe('dispatch', player.getFrameTime() - when)
+
+    def end(self):
+        self.current = None
+
+    def mark(self, stage):
+        if self.current is not None:
+            self.current.mark(stage)
+
+    def attach(self, missile):
+        '''Binds the ongoing touch to the missile it fired'''
+        missile.latencyTrace = self.current
+        self.mark('missile')
+
+    def trailDrawn(self, trace):
+        trace.mark('frame')
+        self.__pending.append(trace)
+
+    def onFrame(self):
+        if not self.__pending:
+            return
+
+        for trace in self.__pending:
+            trace.mark('present')
+            stamps = trace.stamps
+            for name, start, end in self.STAGES:
+                if start in stamps and end in stamps:
+                    self.__observe(name, stamps[end] - stamps[start])
+            self.__observe('total', stamps['present'] - stamps['down'])
+            self.touches += 1
+
+        self.__pending = []
+
+    def report(self):
+        lines = ['Touch latency over the last %d touches (mean/p95 ms):' %
+                len(self.__samples['total'])]
+        for group, stages in self.GROUPS:
+            parts = []
+            for stage in stages:
+                samples = self.__samples[stage]
+                if samples:
+                    p95, = analytics.percentiles(samples, (95,))
+                    parts.append('%s %.1f/%.1f' % (stage,
+                            sum(samples) / len(samples), p95))
+            lines.append('  %s: %s' % (group, ', '.join(parts) or 'no data'))
+
+        samples = self.__samples['total']
+        if samples:
+            p95, = analytics.percentiles(samples, (95,))
+            lines.append('  total: %.1f/%.1f' % (sum(samples) / len(samples), p95))
+
+        return '\n'.join(lines)
+
+    def __observe(self, name, value):
+        self.__histograms[name].observe(value)
+        self.__samples[name].append(value)
+
+
+tracker = LatencyTracker(metrics.registry)
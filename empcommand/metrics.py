@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import os
+import time
+import bisect
+import logging
+import resource
+import threading
+import BaseHTTPServer
+
+import engine
+import consts
+
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    '''Cumulative histogram, to be updated from the frame thread only'''
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return (self.buckets, tuple(self.counts), self.sum, self.count)
+
+
+class Registry(object):
+    '''
+    Frame thread side of the instrumentation.
+
+    Histograms, gauges and counters are only touched by the frame thread, without locks;
+    publish() periodically freezes them into an immutable snapshot, swapped in
+    with a single reference assignment. Readers (the metrics server) only ever
+    see published snapshots, so they can't stall the rendering.
+    '''
+    PREFIX = 'empcommand_'
+
+    def __init__(self):
+        self.__histograms = []
+        self.__gauges = {}
+        self.__counters = {}
+        self.__snapshot = ()
+
+    def histogram(self, name, description, buckets):
+        hist = Histogram(name, description, buckets)
+        self.__histograms.append(hist)
+        return hist
+
+    def setGauge(self, name, description, value, labels=None):
+        '''labels: tuple of (label, value) pairs'''
+        samples = self.__gauges.setdefault(name, (description, {}))[1]
+        samples[labels] = value
+
+    def setCounter(self, name, description, value, labels=None):
+        '''
+        Current total of a value that only increases, exported as <name>_total.
+        labels: tuple of (label, value) pairs
+        '''
+        samples = self.__counters.setdefault(name + '_total', (description, {}))[1]
+        samples[labels] = value
+
+    def clearGauge(self, name):
+        if name in self.__gauges:
+            self.__gauges[name][1].clear()
+
+    def publish(self):
+        snapshot = []
+        for name in sorted(self.__gauges.keys()):
+            description, samples = self.__gauges[name]
+            snapshot.append(('gauge', name, description, tuple(samples.items())))
+
+        for name in sorted(self.__counters.keys()):
+            description, samples = self.__counters[name]
+            snapshot.append(('counter', name, description, tuple(samples.items())))
+
+        for hist in self.__histograms:
+            snapshot.append(('histogram', hist.name, hist.description, hist.snapshot()))
+
+        self.__snapshot = tuple(snapshot)
+
+    def render(self):
+        '''Prometheus text format of the last published snapshot'''
+        lines = []
+        for kind, name, description, data in self.__snapshot:
+            name = self.PREFIX + name
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            if kind in ('gauge', 'counter'):
+                for labels, value in data:
+                    lines.append('%s%s %s' % (name, self.__formatLabels(labels), value))
+            else:
+                buckets, counts, total, count = data
+                cumulative = 0
+                for bound, bucketCount in zip(buckets + ('+Inf',), counts):
+                    cumulative += bucketCount
+                    lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+                lines.append('%s_sum %s' % (name, total))
+                lines.append('%s_count %d' % (name, count))
+
+        return '\n'.join(lines) + '\n'
+
+    def __formatLabels(self, labels):
+        if not labels:
+            return ''
+
+        return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels)
+
+
+class MetricsServer(object):
+    '''Serves /metrics on localhost from a background thread'''
+    def __init__(self, registry, port):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.__httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', port), Handler)
+        self.port = self.__httpd.server_address[1]
+        self.__thread = threading.Thread(target=self.__httpd.serve_forever,
+                name='MetricsServer')
+        self.__thread.daemon = True
+
+    def start(self):
+        self.__thread.start()
+        logger.info('Serving metrics on http://127.0.0.1:%d/metrics' % self.port)
+
+    def stop(self):
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+
+
+def getRSS():
+    '''Resident set size in bytes'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        # Peak RSS, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class GameCollector(object):
+    '''Feeds the registry with the game health data, once per frame'''
+    FRAME_BUCKETS = (8, 12, 16, 17, 20, 25, 33, 50, 100, 250, 1000)
+
+    def __init__(self, mainDiv, registry):
+        self.mainDiv = mainDiv
+        self.registry = registry
+        self.frameTime = registry.histogram('frame_time_ms',
+                'Wall time between frames', self.FRAME_BUCKETS)
+        self.__lastFrame = None
+        self.__lastPublish = 0
+
+    def onFrame(self):
+        now = time.time() * 1000
+        if self.__lastFrame is not None:
+            self.frameTime.observe(now - self.__lastFrame)
+        self.__lastFrame = now
+
+        if now - self.__lastPublish >= consts.METRICS_PUBLISH_INTERVAL:
+            self.__lastPublish = now
+            self.__collect()
+            self.registry.publish()
+
+    def __collect(self):
+        reg = self.registry
+
+        reg.clearGauge('state')
+        reg.setGauge('state', 'Current game state', 1,
+                (('handle', self.mainDiv.sequencer.getCurrentHandle()),))
+
+        world = self.mainDiv.sequencer.getState('game').world
+        for name, objects in (('missile', world.missiles),
+                ('explosion', world.explosions),
+                ('target', world.targets)):
+            reg.setGauge('objects', 'Live game objects', len(objects),
+                    (('kind', name),))
+
+        reg.setGauge('sound_voices', 'Pooled sound samples playing',
+                world.sounds.getNumVoices())
+        for outcome, count in (('requested', world.sounds.requests),
+                ('merged', world.sounds.merged), ('limited', world.sounds.limited)):
+            reg.setCounter('sound_requests', 'Sound play requests', count,
+                    (('outcome', outcome),))
+        reg.setGauge('timers', 'Pending timeouts and intervals',
+                engine.clock.getNumTimers())
+        reg.setGauge('rss_bytes', 'Resident set size', getRSS())
+        reg.setGauge('quality_tier', 'Quality governor tier (0: full quality)',
+                engine.quality.tier)
+        reg.setCounter('quality_tier_changes', 'Quality governor tier changes',
+                engine.quality.changes)
+        reg.setCounter('motion_events', 'Cursor motion events', engine.motion.received,
+                (('stage', 'received'),))
+        reg.setCounter('motion_events', 'Cursor motion events', engine.motion.delivered,
+                (('stage', 'delivered'),))
+        for name, count in engine.census.layers.iteritems():
+            reg.setGauge('scene_nodes', 'Live scene graph nodes', count,
+                    (('layer', name),))
+            reg.setCounter('scene_budget_overruns', 'Times a layer exceeded its budget',
+                    engine.census.overruns.get(name, 0), (('layer', name),))
+        for handle, count in engine.census.states.iteritems():
+            reg.setGauge('scene_nodes', 'Live scene graph nodes', count,
+                    (('state', handle),))
+        reg.setCounter('scene_shed_sprites', 'Cosmetic sprites shed over budget',
+                engine.census.shed)
+        reg.setGauge('idle', 'Framerate lowered for lack of input', int(engine.idle.idle))
+        reg.setCounter('idle_cpu_saved_seconds', 'Estimated CPU time saved while idle',
+                engine.idle.cpuSaved / 1000.0)
+
+
+registry = Registry()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import os
+import time
+import struct
+import logging
+import threading
+
+import consts
+
+
+logger = logging.getLogger(__name__)
+
+
+# Event kinds
+FRAME = 0
+STATE = 1
+GAMESTATE = 2
+SPAWN = 3
+EXPLOSION = 4
+SOUND = 5
+INPUT = 6
+EXCEPTION = 7
+DUMP = 8
+
+KIND_NAMES = ('FRAME', 'STATE', 'GAMESTATE', 'SPAWN', 'EXPLOSION', 'SOUND', 'INPUT',
+        'EXCEPTION', 'DUMP')
+
+MAGIC = 'EMPFR'
+VERSION = 1
+# magic, version, records, names size
+HEADER = struct.Struct('<5sBII')
+# wall time (ms), kind, name id, x, y
+RECORD = struct.Struct('<dBHff')
+
+
+class FlightRecorder(object):
+    '''
+    Keeps the last capacity events in a preallocated ring of fixed size binary
+    records. Names (states, sounds, classes...) are interned in a table, the
+    records only carry their id.
+    The ring is dumped to directory when a frame takes more than hitchThreshold
+    ms (at most once every dumpInterval ms) or on dump().
+    '''
+    def __init__(self, directory=consts.RECORDER_DIR, capacity=consts.RECORDER_CAPACITY,
+            hitchThreshold=consts.RECORDER_HITCH_THRESHOLD,
+            dumpInterval=consts.RECORDER_DUMP_INTERVAL):
+        self.directory = directory
+        self.enabled = bool(directory)
+        self.capacity = capacity
+        self.hitchThreshold = hitchThreshold
+        self.dumpInterval = dumpInterval
+        self.dumps = 0
+
+        self.__buffer = bytearray(RECORD.size * capacity)
+        self.__index = 0
+        self.__count = 0
+        self.__names = []
+        self.__nameIds = {}
+        self.__lastFrame = None
+        self.__lastDump = None
+
+    def record(self, kind, name=None, x=0, y=0):
+        if not self.enabled:
+            return
+
+        if name is None:
+            nameId = 0
+        else:
+            nameId = self.__nameIds.get(name)
+            if nameId is None:
+                nameId = self.__intern(name)
+
+        RECORD.pack_into(self.__buffer, self.__index * RECORD.size,
+                time.time() * 1000, kind, nameId, x, y)
+        self.__index = (self.__index + 1) % self.capacity
+        if self.__count < self.capacity:
+            self.__count += 1
+
+    def onFrame(self, checkHitch=True):
+        '''Records the duration of the last frame, dumps the ring on hitches'''
+        if not self.enabled:
+            return
+
+        now = time.time() * 1000
+        if self.__lastFrame is not None:
+            duration = now - self.__lastFrame
+            self.record(FRAME, x=duration)
+            if (checkHitch and duration > self.hitchThreshold and
+                    (self.__lastDump is None or
+                        now - self.__lastDump > self.dumpInterval)):
+                self.dump('hitch', background=True)
+
+        self.__lastFrame = now
+
+    def dump(self, reason, background=False):
+        '''Writes the ring to a file, returns its path'''
+        if not self.enabled:
+            return None
+
+        self.record(DUMP, reason)
+        self.__lastDump = time.time() * 1000
+        self.dumps += 1
+
+        fileName = os.path.join(self.directory, 'flight-%s-%d-%s.bin' % (
+                time.strftime('%Y%m%d-%H%M%S'), self.dumps, reason))
+        # Oldest record first
+        if self.__count == self.capacity:
+            start = self.__index * RECORD.size
+            records = str(self.__buffer[start:] + self.__buffer[:start])
+        else:
+            records = str(self.__buffer[:self.__count * RECORD.size])
+        names = '\n'.join(self.__names)
+
+        if background:
+            threading.Thread(target=self.__write,
+                    args=(fileName, self.__count, names, records)).start()
+        else:
+            self.__write(fileName, self.__count, names, records)
+
+        return fileName
+
+    def __intern(self, name):
+        # Id 0 stands for no name
+        self.__names.append(name)
+        nameId = len(self.__names)
+        self.__nameIds[name] = nameId
+        return nameId
+
+    def __write(self, fileName, count, names, records):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(fileName, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, count, len(names)))
+                f.write(names)
+                f.write(records)
+        except (IOError, OSError) as e:
+            logger.error('Cannot write flight recording %s: %s' % (fileName, e))
+        else:
+            logger.warning('Flight recording dumped to %s' % fileName)
+
+
+def load(fileName):
+    '''Returns the records of a dump as (time, kind, name, x, y) tuples'''
+    with open(fileName, 'rb') as f:
+        data = f.read()
+
+    magic, version, count, namesSize = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('%s is not a flight recording (v%d)' % (fileName, VERSION))
+
+    offset = HEADER.size
+    names = [None] + data[offset:offset + namesSize].split('\n')
+    offset += namesSize
+
+    records = []
+    for i in xrange(count):
+        when, kind, nameId, x, y = RECORD.unpack_from(data, offset + i * RECORD.size)
+        records.append((when, kind, names[nameId], x, y))
+
+    return records
+
+
+flight = FlightRecorder()
@@ -50,9 +50,9 @@ class ScoreEntry(object):
 
 
 class HiscoreDatabase(object):
-    def __init__(self, app, maxSize=20):
+    def __init__(self, app, maxSize=20, fileName='hiscore'):
         self.__maxSize = maxSize
-        self.__ds = persist.UserPersistentData(appName='empcommand', fileName='hiscore',
+        self.__ds = persist.UserPersistentData(appName='empcommand', fileName=fileName,
                initialData=self.__generateShit,
                validator=self.__validate)
 
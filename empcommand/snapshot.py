@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import os
+import time
+import logging
+import threading
+import cPickle
+import Queue
+
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class SnapshotWriter(object):
+    '''
+    Keeps the snapshot of the ongoing game on disk. Snapshots are captured on the
+    frame thread as plain containers, pickled and written by a background thread.
+    The file is replaced atomically, a crash never leaves a partial snapshot.
+    '''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.__queue = Queue.Queue()
+        self.__thread = threading.Thread(target=self.__run, name='SnapshotWriter')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def save(self, game):
+        self.__queue.put({'version': VERSION, 'time': time.time(), 'game': game})
+
+    def clear(self):
+        '''Drops the snapshot, once the game is over'''
+        self.__queue.put(False)
+
+    def close(self):
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        running = True
+        while running:
+            requests = [self.__queue.get()]
+            while not self.__queue.empty():
+                requests.append(self.__queue.get())
+
+            if None in requests:
+                running = False
+                requests.remove(None)
+
+            # Only the latest request matters
+            if not requests:
+                pass
+            elif requests[-1] is False:
+                self.__remove()
+            else:
+                self.__write(requests[-1])
+
+    def __write(self, snapshot):
+        tmpFile = self.fileName + '.tmp'
+        try:
+            directory = os.path.dirname(self.fileName)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmpFile, 'wb') as f:
+                cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFile, self.fileName)
+        except (IOError, OSError) as e:
+            logger.error('Cannot write snapshot %s: %s' % (self.fileName, e))
+
+    def __remove(self):
+        try:
+            if os.path.exists(self.fileName):
+                os.remove(self.fileName)
+        except OSError as e:
+            logger.error('Cannot remove snapshot %s: %s' % (self.fileName, e))
+
+
+def load(fileName, maxAge=None, consume=False):
+    '''
+    Returns the game data of a snapshot, None when it's missing, unreadable or
+    older than maxAge ms.
+    A consumed snapshot is moved aside once loaded: if the resumed game crashes,
+    the next start doesn't resume it again. The writer puts a new one in place
+    at its first save.
+    '''
+    if not os.path.exists(fileName):
+        return None
+
+    try:
+        with open(fileName, 'rb') as f:
+            snapshot = cPickle.load(f)
+    except Exception as e:
+        logger.warning('Invalid snapshot %s: %s' % (fileName, e))
+        return None
+
+    if not isinstance(snapshot, dict) or snapshot.get('version') != VERSION:
+        logger.warning('Snapshot %s has an unsupported version' % fileName)
+        return None
+
+    if maxAge is not None and (time.time() - snapshot['time']) * 1000 > maxAge:
+        logger.info('Ignoring stale snapshot %s' % fileName)
+        return None
+
+    if consume:
+        try:
+            os.rename(fileName, fileName + '.resumed')
+        except OSError as e:
+            logger.error('Cannot consume snapshot %s, not resuming: %s' % (fileName, e))
+            return None
+
+    return snapshot['game']
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import gc
+import logging
+import weakref
+import itertools
+
+import libavg
+from libavg import avg
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import engine
+import consts
+import metrics
+import bot
+from empcommand import EmpCommand
+from gameobjs import LayeredSprite
+
+
+logger = logging.getLogger(__name__)
+
+
+def walkNodes(node):
+    yield node
+    if isinstance(node, avg.DivNode):
+        for i in xrange(node.getNumChildren()):
+            for child in walkNodes(node.getChild(i)):
+                yield child
+
+
+class GrowthTracker(object):
+    '''
+    Series of samples of a resource which is expected to be bounded.
+    The resource is considered leaking when, after the warmup, the second half of
+    the samples is entirely above the first half and the trend exceeds the
+    tolerance (units per sample).
+    '''
+    def __init__(self, name, tolerance=0, warmup=consts.SOAK_WARMUP_SAMPLES):
+        self.name = name
+        self.tolerance = tolerance
+        self.warmup = warmup
+        self.samples = []
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def getSlope(self):
+        samples = self.samples[self.warmup:]
+        n = len(samples)
+        if n < 2:
+            return 0
+
+        mx = (n - 1) / 2.0
+        my = sum(samples) / float(n)
+        num = sum((x - mx) * (y - my) for x, y in enumerate(samples))
+        den = sum((x - mx) ** 2 for x in xrange(n))
+
+        return num / den
+
+    def isGrowing(self):
+        samples = self.samples[self.warmup:]
+        if len(samples) < consts.SOAK_MIN_SAMPLES:
+            return False
+
+        half = len(samples) // 2
+        return (min(samples[half:]) > max(samples[:half]) and
+                self.getSlope() > self.tolerance)
+
+    def __repr__(self):
+        if self.samples:
+            return '%s: %s -> %s (slope=%.2f/wave)%s' % (self.name, self.samples[0],
+                    self.samples[-1], self.getSlope(),
+                    ' LEAKING' if self.isGrowing() else '')
+        else:
+            return '%s: no samples' % self.name
+
+
+class SoakDriver(object):
+    '''
+    Drives the whole state machine (attract, play, results, hiscore) with a bot
+    player, sampling the live resources after every wave
+    '''
+    SAMPLING_STATES = ('results', 'gameover')
+
+    def __init__(self, hours, attractTime=consts.SOAK_ATTRACT_TIME,
+            touchRate=2.5, fingers=1, skill=0.7):
+        self.duration = hours * 3600 * 1000
+        self.attractTime = attractTime
+        self.touchRate = touchRate
+        self.fingers = fingers
+        self.skill = skill
+        self.waves = 0
+        self.resetSurvivors = 0
+        self.failed = False
+
+        self.__mainDiv = None
+        self.__bot = None
+        self.__startTime = None
+        self.__lastTime = None
+        self.__lastHandle = None
+        self.__attractElapsed = 0
+        self.__baselineSnapshot = None
+        self.__lastSnapshot = None
+
+        self.trackers = {}
+        for name in ('nodes', 'soundNodes', 'timers', 'anims', 'missiles',
+                'explosions', 'targets', 'bonuses', 'spawnTimestamps', 'sprites',
+                'clearTimers', 'clearAnims'):
+            self.trackers[name] = GrowthTracker(name)
+
+        # Memory is tracked on every python version, tracemalloc (3.4+) tells where
+        self.trackers['rss'] = GrowthTracker('rss', tolerance=consts.SOAK_RSS_TOLERANCE)
+        self.trackers['pyObjects'] = GrowthTracker('pyObjects',
+                tolerance=consts.SOAK_OBJECTS_TOLERANCE)
+        if tracemalloc is not None:
+            self.trackers['tracedMemory'] = GrowthTracker('tracedMemory',
+                    tolerance=consts.SOAK_MEMORY_TOLERANCE)
+
+    def attach(self, mainDiv):
+        self.__mainDiv = mainDiv
+        self.__bot = bot.Bot(mainDiv, touchRate=self.touchRate,
+                fingers=self.fingers, skill=self.skill)
+
+        world = mainDiv.sequencer.getState('game').world
+        clear = world.clear
+        world.clear = lambda: self.__checkClear(world, clear)
+
+        if tracemalloc is not None:
+            tracemalloc.start()
+        else:
+            logger.info('tracemalloc not available, memory tracked by RSS and objects')
+
+    def step(self):
+        now = engine.clock.getTime()
+        if self.__startTime is None:
+            self.__startTime = self.__lastTime = now
+
+        dt = now - self.__lastTime
+        self.__lastTime = now
+
+        handle = self.__mainDiv.sequencer.getCurrentHandle()
+
+        if handle != self.__lastHandle:
+            if handle in self.SAMPLING_STATES:
+                self.__sample()
+            self.__attractElapsed = 0
+            self.__bot.reset()
+            self.__lastHandle = handle
+
+        if handle == 'start':
+            self.__attractElapsed += dt
+            if self.__attractElapsed >= self.attractTime:
+                self.__attractElapsed = 0
+                self.__mainDiv.sequencer.getState('game').setNewGame()
+                self.__mainDiv.sequencer.changeState('game')
+        elif handle == 'game':
+            self.__bot.update(dt)
+
+        if now - self.__startTime >= self.duration:
+            self.__finish()
+
+    def report(self):
+        if self.__bot is not None:
+            logger.info('Soak run: %d waves, %d bot taps, %d bonus drags' % (
+                    self.waves, self.__bot.taps, self.__bot.drags))
+        if self.resetSurvivors:
+            logger.error('Game objects surviving resets: %d' % self.resetSurvivors)
+        for name in sorted(self.trackers.keys()):
+            tracker = self.trackers[name]
+            if tracker.isGrowing():
+                logger.error(str(tracker))
+            else:
+                logger.info(str(tracker))
+
+        if self.__baselineSnapshot is not None and self.__lastSnapshot is not None:
+            logger.info('Top memory growth since warmup:')
+            for stat in self.__lastSnapshot.compare_to(self.__baselineSnapshot,
+                    'lineno')[:10]:
+                logger.info('  %s' % stat)
+
+        return not self.failed
+
+    def __checkClear(self, world, clear):
+        '''
+        Runs World.clear() and checks that it left nothing behind: no object
+        still referenced (by a timer, an anim callback, an event handler...),
+        no new timer or anim
+        '''
+        refs = map(weakref.ref, itertools.chain(world.targets, world.missiles,
+                world.explosions, world.bonuses, world.cosmetics))
+        timers = engine.clock.getNumTimers()
+        anims = avg.getNumRunningAnims()
+
+        clear()
+        gc.collect()
+
+        survivors = [ref() for ref in refs if ref() is not None]
+        remaining = world.countObjects()
+        timersAfter = engine.clock.getNumTimers()
+        animsAfter = avg.getNumRunningAnims()
+        self.trackers['clearTimers'].add(timersAfter)
+        self.trackers['clearAnims'].add(animsAfter)
+
+        if survivors or remaining or timersAfter > timers or animsAfter > anims:
+            logger.error('Reset left %d of %d objects alive (%s), %d registered, '
+                    'timers %d -> %d, anims %d -> %d' % (len(survivors), len(refs),
+                    ', '.join(sorted(set(o.__class__.__name__ for o in survivors))),
+                    remaining, timers, timersAfter, anims, animsAfter))
+            self.resetSurvivors += max(len(survivors) + remaining, 1)
+
+    def __sample(self):
+        self.waves += 1
+        gc.collect()
+
+        # Inactive states are detached from the main div
+        roots = [self.__mainDiv] + [state for state in
+                self.__mainDiv.sequencer.getStates() if state.getParent() is None]
+
+        nodes = soundNodes = 0
+        for root in roots:
+            for node in walkNodes(root):
+                nodes += 1
+                if isinstance(node, avg.SoundNode):
+                    soundNodes += 1
+
+        sprites = pyObjects = 0
+        for obj in gc.get_objects():
+            pyObjects += 1
+            if isinstance(obj, LayeredSprite):
+                sprites += 1
+
+        self.trackers['nodes'].add(nodes)
+        self.trackers['soundNodes'].add(soundNodes)
+        self.trackers['timers'].add(engine.clock.getNumTimers())
+        self.trackers['anims'].add(avg.getNumRunningAnims())
+        world = self.__mainDiv.sequencer.getState('game').world
+        self.trackers['missiles'].add(len(world.missiles))
+        self.trackers['explosions'].add(len(world.explosions))
+        self.trackers['targets'].add(len(world.targets))
+        self.trackers['bonuses'].add(len(world.bonuses))
+        self.trackers['spawnTimestamps'].add(len(world.spawnTimestamp))
+        self.trackers['sprites'].add(sprites)
+        self.trackers['pyObjects'].add(pyObjects)
+        rss = metrics.getRSS()
+        self.trackers['rss'].add(rss)
+
+        if tracemalloc is not None:
+            self.trackers['tracedMemory'].add(tracemalloc.get_traced_memory()[0])
+            snapshot = tracemalloc.take_snapshot()
+            if self.waves == consts.SOAK_WARMUP_SAMPLES:
+                self.__baselineSnapshot = snapshot
+            self.__lastSnapshot = snapshot
+
+        logger.info('Soak sample %d: nodes=%d sounds=%d timers=%d sprites=%d '
+                'objects=%d rss=%dkB' % (self.waves, nodes, soundNodes,
+                engine.clock.getNumTimers(), sprites, pyObjects, rss / 1024))
+
+    def __finish(self):
+        self.failed = (any(t.isGrowing() for t in self.trackers.values()) or
+                self.resetSurvivors > 0)
+        libavg.player.stop()
+
+
+class SoakEmpCommand(EmpCommand):
+    HISCORE_FILE = 'hiscore-soak'
+    ANALYTICS_DIR = None
+    SNAPSHOT_FILE = None
+    driver = None
+
+    def createGame(self):
+        super(SoakEmpCommand, self).createGame()
+        self.driver.attach(self)
+
+    def onFrame(self):
+        super(SoakEmpCommand, self).onFrame()
+        self.driver.step()
+
+
+def run(hours, clockSpec='free', resolution='1280x800', **kwargs):
+    '''Runs the soak test, returns True when no leak has been detected'''
+    engine.setClock(engine.createClock(clockSpec))
+
+    mainDiv = SoakEmpCommand()
+    mainDiv.driver = SoakDriver(hours, **kwargs)
+    libavg.app.App().run(mainDiv, app_resolution=resolution, app_fullscreen='false')
+
+    return mainDiv.driver.report()
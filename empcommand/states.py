@@ -41,6 +41,10 @@ import engine
 import consts
 import widgets
 import score
+import analytics
+import assets
+import recorder
+import latency
 from gameobjs import *
 
 
@@ -48,12 +52,13 @@ logger = logging.getLogger(__name__)
 
 
 class Start(engine.FadeGameState):
-    def _init(self):
-        im = avg.ImageNode(href='logo.png', parent=self)
+    IDLE_CAPABLE = True
 
-        xfactor = engine.norm.size.x / im.getMediaSize().x / 2
-        im.size = im.getMediaSize() * xfactor
-        im.pos = (0, engine.norm.size.y - im.size.y)
+    def _init(self):
+        mediaSize = assets.cache.getMediaSize('logo.png')
+        logoSize = mediaSize * (engine.norm.size.x / mediaSize.x / 2)
+        widgets.PrescaledImage('logo.png', logoSize,
+                pos=(0, engine.norm.size.y - logoSize.y), parent=self)
 
         rightPane = avg.DivNode(pos=engine.norm.p((765, 90)), parent=self)
 
@@ -104,10 +109,12 @@ class Start(engine.FadeGameState):
 
 
 class About(engine.FadeGameState):
+    IDLE_CAPABLE = True
+
     def _init(self):
-        im = avg.ImageNode(href='logo.png', parent=self)
-        xfactor = engine.norm.size.x / im.getMediaSize().x / 2
-        im.size = im.getMediaSize() * xfactor
+        mediaSize = assets.cache.getMediaSize('logo.png')
+        widgets.PrescaledImage('logo.png',
+                mediaSize * (engine.norm.size.x / mediaSize.x / 2), parent=self)
 
         about = widgets.VLayout(interleave=10, width=600, pos=engine.norm.p((580, 300)),
                 parent=self)
@@ -141,18 +148,18 @@ class About(engine.FadeGameState):
                 text='This game is based on libavg (http://www.libavg.de)',
                 color=consts.COLOR_RED, fontsize=16), offset=10)
 
-        avg.ImageNode(href='enmy_sky.png', size=(engine.norm.size.x, engine.norm.y(300)),
+        widgets.PrescaledImage('enmy_sky.png', (engine.norm.size.x, engine.norm.y(300)),
                 pos=(0, engine.norm.size.y - engine.norm.y(300)), angle=math.pi,
                 opacity=0.2, parent=self)
 
         self.registerBgTrack('theme_about.ogg', maxVolume=0.5)
 
     def _onTouch(self, event):
-        engine.SoundManager.play('click.ogg')
+        engine.sounds.play('click.ogg')
         self.sequencer.changeState('start')
 
     def _onKeyDown(self, event):
-        engine.SoundManager.play('click.ogg')
+        engine.sounds.play('click.ogg')
         self.sequencer.changeState('start')
         return True
 
@@ -161,28 +168,32 @@ class Game(engine.FadeGameState):
     GAMESTATE_INITIALIZING = 'INIT'
     GAMESTATE_PLAYING = 'PLAY'
     GAMESTATE_ULTRASPEED = 'ULTRA'
+    GAME_TOTALS = {'enemiesDestroyed': 0, 'ammoFired': 0}
 
     def _init(self):
+        self.world = World(game=self)
+
         # Sky
-        avg.ImageNode(href='enmy_sky.png', size=(engine.norm.size.x, engine.norm.y(300)),
+        widgets.PrescaledImage('enmy_sky.png', (engine.norm.size.x, engine.norm.y(300)),
                 opacity=0.3, parent=self)
         self.clouds = widgets.Clouds(maxOpacity=0.4, size=(engine.norm.size.x,
                 engine.norm.y(600)), parent=self)
-        EnemyExplosion.registerCallback(self.clouds.blink)
+        self.world.registerCallback(EnemyExplosion, self.clouds.blink)
 
         # Allied ground
-        a = engine.norm.x(5)
-        b = engine.norm.y(10)
-        c = engine.norm.x(30)
-        d = engine.norm.y(5)
-        ito = engine.norm.y(consts.INVALID_TARGET_Y_OFFSET)
+        norm = self.world.norm
+        a = norm.x(5)
+        b = norm.y(10)
+        c = norm.x(30)
+        d = norm.y(5)
+        ito = norm.y(consts.INVALID_TARGET_Y_OFFSET)
         polpos = (
-            (-a, engine.norm.size.y - ito + b),
-            (c, engine.norm.size.y - ito),
-            (engine.norm.size.x - c, engine.norm.size.y - ito),
-            (engine.norm.size.x + a, engine.norm.size.y - ito + b),
-            (engine.norm.size.x + a, engine.norm.size.y + d),
-            (-a, engine.norm.size.y + d),
+            (-a, norm.size.y - ito + b),
+            (c, norm.size.y - ito),
+            (norm.size.x - c, norm.size.y - ito),
+            (norm.size.x + a, norm.size.y - ito + b),
+            (norm.size.x + a, norm.size.y + d),
+            (-a, norm.size.y + d),
         )
 
         avg.PolygonNode(
@@ -205,24 +216,33 @@ class Game(engine.FadeGameState):
         divPlayground = avg.DivNode(parent=self)
         divTouchables = avg.DivNode(parent=self)
 
-        Target.initLayer(divPlayground)
-        Missile.initLayer(divPlayground)
-        TextFeedback.initLayer(divPlayground)
-        Explosion.initLayer(divPlayground)
-        TouchFeedback.initLayer(divPlayground)
-        Bonus.initLayer(divTouchables)
+        self.world.initLayer(Target, divPlayground)
+        self.world.initLayer(Missile, divPlayground)
+        self.world.initLayer(TextFeedback, divPlayground)
+        self.world.initLayer(Explosion, divPlayground)
+        self.world.initLayer(TouchFeedback, divPlayground)
+        self.world.initLayer(Bonus, divTouchables)
+        self.world.watchLayers(engine.census)
+        TextFeedback.preload(norm)
 
         self.gameData = {}
         self.nukeFired = False
         self.__score = 0
         self.__enemiesSpawnTimeline = []
+        self.__wavePlan = None
         self.__enemiesGone = 0
         self.__gameState = self.GAMESTATE_INITIALIZING
         self.__wave = 0
+        self.__waveTimer = 0
+        self.__frameTimes = []
+        self.__gameTimer = 0
+        self.__gameTotals = dict(self.GAME_TOTALS)
+        self.__lastSnapshot = 0
+        self.__resumeData = None
 
-        engine.SoundManager.allocate('buzz.ogg')
+        self.world.sounds.allocate('buzz.ogg')
 
-        self.__scoreText = widgets.GameWordsNode(text='0',
+        self.__scoreText = widgets.GlyphText(text='0',
                 pos=(engine.norm.size.x / 2, engine.norm.y(100)),
                 alignment='center', fontsize=50, opacity=0.5, parent=self)
         self.__teaser = widgets.GameWordsNode(text='',
@@ -261,7 +281,11 @@ class Game(engine.FadeGameState):
         self.reset()
 
     def _postTransIn(self):
-        self.nextWave()
+        if self.__resumeData is not None:
+            self.__restore(self.__resumeData)
+            self.__resumeData = None
+        else:
+            self.nextWave()
         widgets.CrossHair.warningy = engine.norm.size.y - \
                 engine.norm.y(consts.INVALID_TARGET_Y_OFFSET)
 
@@ -275,58 +299,101 @@ class Game(engine.FadeGameState):
                 'initialEnemies': 0,
                 'initialAmmo': 0,
                 'initialCities': 0,
+                'enemiesSpawned': 0,
                 'enemiesDestroyed': 0,
                 'ammoFired': 0,
+                'ammoBonuses': 0,
+                'nukeBonuses': 0,
             }
 
-        for obj in Target.objects + Missile.objects:
-            obj.destroy()
+        self.world.clear()
+
+        # Totals accumulate over the waves, a game might start without
+        # setNewGame() (debug shortcuts)
+        for key, value in self.GAME_TOTALS.iteritems():
+            self.__gameTotals.setdefault(key, value)
 
         self.__quitSwitch.reset()
         self.__lowAmmoNotified = False
 
     def setNewGame(self):
+        self.world.difficulty = app.instance.mainDiv.difficultyLevel
         self.__wave = 0
         self.setScore(0)
+        self.__gameTimer = engine.clock.getTime()
+        self.__gameTotals = dict(self.GAME_TOTALS)
 
     def nextWave(self):
-        Missile.speedMul = 1 + (app.instance.mainDiv.difficultyLevel - 1) * consts.SPEEDMUL_OFFSET_LEVEL
+        self.world.setSpeedMul(1 + (self.world.difficulty - 1) *
+                consts.SPEEDMUL_OFFSET_LEVEL)
         self.nukeFired = False
         self.__wave += 1
 
-        nenemies =  int(self.__wave * consts.ENEMIES_WAVE_MULT * \
-                (1 + app.instance.mainDiv.difficultyLevel * 0.2))
+        # Usually prepared during the results of the previous wave
+        plan = self.__wavePlan
+        self.__wavePlan = None
+        if plan is None or not plan.matches(self.__wave, self.world.difficulty):
+            plan = WavePlan(self.__wave, self.world.difficulty, self.world.norm)
+        plan.advance()
 
-        self.__createSpawnTimeline(nenemies)
+        self.__enemiesSpawnTimeline = plan.timeline
         self.__enemiesGone = 0
-        self.gameData['initialEnemies'] = nenemies
-
-        slots = [Point2D(x * engine.norm.x(consts.SLOT_WIDTH), engine.norm.size.y - \
-                engine.norm.y(60))
-                    for x in xrange(1,
-                        int(engine.norm.size.x/engine.norm.x(consts.SLOT_WIDTH) + 1))]
+        self.gameData['initialEnemies'] = plan.nenemies
+        self.gameData['initialAmmo'] = plan.initialAmmo
+        self.gameData['initialCities'] = len(plan.cities)
 
-        random.shuffle(slots)
+        for slot, nodes in plan.turrets:
+            Turret(self.world, slot, float(plan.initialAmmo) / consts.TURRETS_AMOUNT,
+                    nodes=nodes)
 
-        self.gameData['initialAmmo'] = int(nenemies * consts.AMMO_ENEMIES_MULT)
-        self.gameData['initialCities'] = consts.CITIES
-
-        for i in xrange(0, consts.TURRETS_AMOUNT):
-            Turret(slots.pop(), float(self.gameData['initialAmmo']) /
-                    consts.TURRETS_AMOUNT)
-
-        for c in xrange(0, self.gameData['initialCities']):
-            City(slots.pop())
+        for slot, nodes in plan.cities:
+            City(self.world, slot, nodes=nodes)
 
         self.__ammoGauge.setColor(consts.COLOR_BLUE)
         self.__ammoGauge.setFVal(1)
         self.__enemiesGauge.setFVal(1)
 
         self.playTeaser('Wave %d' % self.__wave)
-        self.__waveTimer = player.getFrameTime()
+        self.__waveTimer = engine.clock.getTime()
+        self.__frameTimes = []
         self.__changeGameState(self.GAMESTATE_PLAYING)
         logger.info('Entering wave %d: %s' % (self.__wave, str(self.gameData)))
 
+    def prepareNextWave(self, budget):
+        '''Builds the next wave ahead of time, for about budget ms per call'''
+        wave = self.__wave + 1
+        if (self.__wavePlan is None or
+                not self.__wavePlan.matches(wave, self.world.difficulty)):
+            self.__wavePlan = WavePlan(wave, self.world.difficulty, self.world.norm)
+
+        return self.__wavePlan.advance(budget)
+
+    def getSnapshot(self, waveEnded=False):
+        '''
+        Whole game state as plain containers. The snapshot of an ended wave
+        (already logged) resumes with the next one
+        '''
+        now = engine.clock.getTime()
+        return {
+            'waveEnded': waveEnded,
+            'wave': self.__wave,
+            'score': self.__score,
+            'gameState': self.__gameState,
+            'gameData': dict(self.gameData),
+            'gameTotals': dict(self.__gameTotals),
+            'nukeFired': self.nukeFired,
+            'enemiesGone': self.__enemiesGone,
+            'lowAmmoNotified': self.__lowAmmoNotified,
+            'spawnTimeline': list(self.__enemiesSpawnTimeline),
+            'waveTime': now - self.__waveTimer,
+            'gameTime': now - self.__gameTimer,
+            'world': self.world.getSnapshot(),
+        }
+
+    def resume(self, data):
+        '''The game continues from a snapshot the next time the state is entered'''
+        self.__resumeData = data
+
     def playTeaser(self, text):
         self.__teaser.text = text
         avg.Anim.fadeIn(self.__teaser, 200, 1, self.__teaserTimer)
@@ -343,11 +410,24 @@ class Game(engine.FadeGameState):
         self.__score = val
 
         if update:
-            self.__scoreText.text = str(self.__score)
+            self.__scoreText.setText(str(self.__score))
 
     def getLevel(self):
         return self.__wave
 
+    def getAccuracy(self):
+        if self.gameData['ammoFired'] == 0:
+            return 0
+        else:
+            return (float(self.gameData['enemiesDestroyed']) /
+                    self.gameData['ammoFired'] * 100)
+
+    def bonusDeployed(self, bonus):
+        if isinstance(bonus, NukeBonus):
+            self.gameData['nukeBonuses'] += 1
+        else:
+            self.gameData['ammoBonuses'] += 1
+
     def addScore(self, add):
         newscore = self.__score + int(add)
         if newscore < 0:
@@ -356,49 +436,66 @@ class Game(engine.FadeGameState):
 
     def _update(self, dt):
         if self.__gameState != self.GAMESTATE_INITIALIZING:
-            if consts.DEBUG:
+            if consts.DEBUG and engine.clock.frames % engine.quality.debugRefresh == 0:
                 ammoRatio = float(
                         self.gameData['ammoFired']) / self.gameData['initialAmmo']
                 self.__debugArea.text = (
                         ('dt=%03dms ar=%1.2f' % (dt,
                             ammoRatio)) + '<br/>' +
                         str(self.gameData) + '<br/>' +
-                        str(Target.objects) + '<br/>' +
-                        '<br/>'.join(map(str, Missile.filter(Enemy))) + '<br/>' +
-                        '<br/>'.join(map(str, Missile.filter(TurretMissile))))
+                        str(self.world.targets) + '<br/>' +
+                        '<br/>'.join(map(str,
+                            self.world.filter(self.world.missiles, Enemy))) + '<br/>' +
+                        '<br/>'.join(map(str,
+                            self.world.filter(self.world.missiles, TurretMissile))))
 
-            Missile.update(dt)
+            self.world.update(dt)
             self.__checkGameStatus()
             self.__spawnEnemy()
 
-    def _onTouch(self, event):
-        turrets = filter(lambda o: o.hasAmmo(), Target.filter(Turret))
-        if turrets:
-            ito = engine.norm.y(consts.INVALID_TARGET_Y_OFFSET)
-            if event.pos.y < engine.norm.size.y - ito:
-                if len(turrets) > 1:
-                    d = abs(turrets[0].getHitPos().x - event.pos.x)
-                    selectedTurret = turrets[0]
-
-                    for t in turrets[1:]:
-                        if abs(t.getHitPos().x - event.pos.x) < d:
-                            d = abs(t.getHitPos().x - event.pos.x)
-                            selectedTurret = t
-                else:
-                    selectedTurret = turrets[0]
+            if (engine.clock.getTime() - self.__lastSnapshot >= consts.SNAPSHOT_INTERVAL
+                    and self.__gameState != self.GAMESTATE_INITIALIZING):
+                self.__saveSnapshot()
+
+    def selectTurret(self, pos):
+        '''Turret which fires at pos: the closest one (with ammo) on the x axis'''
+        turrets = filter(lambda o: o.hasAmmo(),
+                self.world.filter(self.world.targets, Turret))
+        if not turrets:
+            return None
+
+        d = abs(turrets[0].getHitPos().x - pos.x)
+        selectedTurret = turrets[0]
+
+        for t in turrets[1:]:
+            if abs(t.getHitPos().x - pos.x) < d:
+                d = abs(t.getHitPos().x - pos.x)
+                selectedTurret = t
+
+        return selectedTurret
+
+    def _frameRendered(self, frameTime):
+        if self.__gameState != self.GAMESTATE_INITIALIZING:
+            self.__frameTimes.append(frameTime)
 
+    def _onTouch(self, event):
+        latency.tracker.mark('game')
+        selectedTurret = self.selectTurret(event.pos)
+        if selectedTurret:
+            ito = self.world.norm.y(consts.INVALID_TARGET_Y_OFFSET)
+            if event.pos.y < self.world.norm.size.y - ito:
                 selectedTurret.fire(event.pos)
                 self.gameData['ammoFired'] += 1
                 self.updateAmmoGauge()
 
-                TouchFeedback(event.pos, consts.COLOR_BLUE)
+                TouchFeedback(self.world, event.pos, consts.COLOR_BLUE)
             else:
-                TouchFeedback(event.pos, consts.COLOR_RED)
-                engine.SoundManager.play('buzz.ogg', volume=0.5)
+                TouchFeedback(self.world, event.pos, consts.COLOR_RED)
+                self.world.sounds.play('buzz.ogg', volume=0.5)
         else:
-            TouchFeedback(event.pos, consts.COLOR_RED)
-            engine.SoundManager.play('buzz.ogg', volume=0.5)
-            TextFeedback(event.pos, 'AMMO DEPLETED!', consts.COLOR_RED)
+            TouchFeedback(self.world, event.pos, consts.COLOR_RED)
+            self.world.sounds.play('buzz.ogg', volume=0.5)
+            TextFeedback(self.world, event.pos, 'AMMO DEPLETED!', consts.COLOR_RED)
 
     def _onKeyDown(self, event):
         if consts.DEBUG:
@@ -409,11 +506,11 @@ class Game(engine.FadeGameState):
                 self.sequencer.changeState('results')
                 return True
             elif event.keyname == 'D':
-                Target.filter(Turret)[0].hit()
+                self.world.filter(self.world.targets, Turret)[0].hit()
                 self.updateAmmoGauge()
                 return True
             elif event.keyname == 'U':
-                Missile.speedMul = consts.ULTRASPEED_MISSILE_MUL
+                self.world.setSpeedMul(consts.ULTRASPEED_MISSILE_MUL)
                 self.__changeGameState(self.GAMESTATE_ULTRASPEED)
                 return True
             elif event.keyname == 'N':
@@ -421,13 +518,14 @@ class Game(engine.FadeGameState):
                 self.sequencer.changeState('game')
                 return True
             elif event.keyname == 'B':
-                NukeBonus((200, 200))
+                NukeBonus(self.world, (200, 200))
                 return True
             elif event.keyname == 'A':
-                AmmoBonus((300, 200))
+                AmmoBonus(self.world, (300, 200))
                 return True
             elif event.keyname == 'K':
-                map(lambda o: o.explode(o.traj.pos2), Missile.filter(Enemy))
+                map(lambda o: o.explode(o.traj.pos2),
+                        self.world.filter(self.world.missiles, Enemy))
                 return True
             elif event.keyname == 'S':
                 self.addScore(5000)
@@ -444,93 +542,182 @@ class Game(engine.FadeGameState):
                 return True
 
     def updateAmmoGauge(self):
-        ammo = 0
-        for t in Target.filter(Turret):
-            ammo += t.getAmmo()
-
-        fdammo = self.gameData['initialAmmo'] - ammo
+        fdammo = self.gameData['initialAmmo'] - self.world.status.ammo
         afv = 1 - float(fdammo) / self.gameData['initialAmmo']
         if afv < 0.2 and not self.__lowAmmoNotified:
             self.__ammoGauge.setColor(consts.COLOR_RED)
-            engine.SoundManager.play('low_ammo.ogg', volume=0.5)
-            TextFeedback(self.__ammoGauge.pos + self.__ammoGauge.size / 2 + \
+            self.world.sounds.play('low_ammo.ogg', volume=0.5)
+            TextFeedback(self.world, self.__ammoGauge.pos + self.__ammoGauge.size / 2 + \
                     Point2D(engine.norm.x(250), 0),
                     'Low ammo!', consts.COLOR_RED)
             self.__lowAmmoNotified = True
         self.__ammoGauge.setFVal(afv)
 
-    def enemyDestroyed(self, enemy, target=None):
-        self.__enemiesGone += 1
-        self.__enemiesGauge.setFVal(
-                1 - float(self.__enemiesGone) /
-                self.gameData['initialEnemies'])
+    def enemiesKilled(self, count):
+        self.__enemiesGone += count
+        self.__updateEnemiesGauge()
+        self.addScore(count * int(consts.ENEMY_DESTROYED_SCORE *
+                (1 + self.world.difficulty * 0.3)))
+        self.gameData['enemiesDestroyed'] += count
 
+    def enemyDestroyed(self, enemy, target=None):
         if target is None:
-            self.addScore(consts.ENEMY_DESTROYED_SCORE *
-                    (1 + app.instance.mainDiv.difficultyLevel * 0.3))
-            self.gameData['enemiesDestroyed'] += 1
+            self.enemiesKilled(1)
         else:
+            self.__enemiesGone += 1
+            self.__updateEnemiesGauge()
+
             avg.EaseInOutAnim(self.explGround, 'fillopacity', 200,
                     0.2, 0, 0, 200).start()
 
             if not target.isDead and target.hit():
-                TextFeedback(target.getHitPos(), 'BUSTED!', consts.COLOR_RED)
+                TextFeedback(self.world, target.getHitPos(), 'BUSTED!', consts.COLOR_RED)
                 # If we lose a turret, ammo stash sinks with it
                 self.updateAmmoGauge()
 
-    def __getWaveTime(self):
-        return player.getFrameTime() - self.__waveTimer
-
-    def __createSpawnTimeline(self, nenemies):
-        self.__enemiesSpawnTimeline = []
-        avgSpawnTime = consts.WAVE_DURATION * 1000.0 / nenemies
-        absJitter = int(avgSpawnTime * consts.ENEMIES_SPAWNER_JITTER_FACTOR)
-        tm = consts.WAVE_PREAMBLE * 1000
-
-        for i in xrange(nenemies):
-            self.__enemiesSpawnTimeline.append(tm)
-            tm += avgSpawnTime + random.randrange(-absJitter, absJitter)
+    def __updateEnemiesGauge(self):
+        self.__enemiesGauge.setFVal(
+                1 - float(self.__enemiesGone) /
+                self.gameData['initialEnemies'])
 
-        logger.info('Avg spawn time: %d Abs jitter: %d' % (avgSpawnTime, absJitter))
+    def __getWaveTime(self):
+        return engine.clock.getTime() - self.__waveTimer
 
     def __checkGameStatus(self):
         if self.__gameState not in (self.GAMESTATE_PLAYING, self.GAMESTATE_ULTRASPEED):
             return
 
         # Game end
-        if not Target.filter(City):
+        if self.world.status.citiesAlive == 0:
+            self.__logWave(analytics.OUTCOME_GAMEOVER)
+            self.__clearSnapshot()
             self.sequencer.changeState('gameover')
+            return
 
         # Wave end
-        if not self.__enemiesSpawnTimeline and not Missile.filter(Enemy):
+        if not self.__enemiesSpawnTimeline and self.world.status.enemiesAlive == 0:
             logger.info('Wave ended')
+            self.__logWave(analytics.OUTCOME_CLEARED)
+            # A restart during the results resumes with the next wave
+            self.__saveSnapshot(waveEnded=True)
             self.sequencer.changeState('results')
 
         # Switch to ultraspeed if there's nothing the player can do
         if (self.__ammoGauge.getFVal() == 0 and
-                not Missile.filter(TurretMissile) and
-                not Explosion.filter(EmpExplosion) and
+                self.world.status.turretMissiles == 0 and
+                self.world.status.activeEmps == 0 and
                 self.__gameState == self.GAMESTATE_PLAYING):
-            Missile.speedMul = consts.ULTRASPEED_MISSILE_MUL
+            self.world.setSpeedMul(consts.ULTRASPEED_MISSILE_MUL)
             self.__changeGameState(self.GAMESTATE_ULTRASPEED)
 
     def __spawnEnemy(self):
-        if (self.__enemiesSpawnTimeline and Target.objects and
+        if (self.__enemiesSpawnTimeline and self.world.targets and
                 (self.__gameState == self.GAMESTATE_ULTRASPEED or
                 self.__enemiesSpawnTimeline[0] < self.__getWaveTime())):
             self.__enemiesSpawnTimeline.pop(0)
-            origin = Point2D(random.randrange(0, engine.norm.size.x), 0)
-            target = random.choice(Target.objects)
-            Enemy(origin, target, self.__wave)
+            self.gameData['enemiesSpawned'] += 1
+            origin = Point2D(random.randrange(0, self.world.norm.size.x), 0)
+            target = random.choice(self.world.targets)
+            Enemy(self.world, origin, target, self.__wave)
 
     def __teaserTimer(self):
-        player.setTimeout(1000, lambda: avg.Anim.fadeOut(self.__teaser, 3000))
+        engine.clock.setTimeout(1000, lambda: avg.Anim.fadeOut(self.__teaser, 3000))
 
     def __changeGameState(self, newState):
         logger.info('Gamestate %s -> %s' % (self.__gameState, newState))
+        recorder.flight.record(recorder.GAMESTATE, newState)
         self.__gameState = newState
 
+    def __logWave(self, outcome):
+        log = app.instance.mainDiv.analytics
+        self.__gameTotals['enemiesDestroyed'] += self.gameData['enemiesDestroyed']
+        self.__gameTotals['ammoFired'] += self.gameData['ammoFired']
+
+        if log is None:
+            return
+
+        p50, p95, p99 = analytics.percentiles(self.__frameTimes, (50, 95, 99))
+        log.logWave({
+                'difficulty': self.world.difficulty,
+                'wave': self.__wave,
+                'outcome': outcome,
+                'enemiesSpawned': self.gameData['enemiesSpawned'],
+                'enemiesDestroyed': self.gameData['enemiesDestroyed'],
+                'initialEnemies': self.gameData['initialEnemies'],
+                'ammoFired': self.gameData['ammoFired'],
+                'initialAmmo': self.gameData['initialAmmo'],
+                'citiesLost': (self.gameData['initialCities'] -
+                        self.world.status.citiesAlive),
+                'nukeFired': int(self.nukeFired),
+                'ammoBonuses': self.gameData['ammoBonuses'],
+                'nukeBonuses': self.gameData['nukeBonuses'],
+                'duration': int(self.__getWaveTime()),
+                'frameP50': p50,
+                'frameP95': p95,
+                'frameP99': p99,
+                'frameMax': max(self.__frameTimes or [0]),
+            })
+
+        if outcome != analytics.OUTCOME_CLEARED:
+            log.logGame({
+                    'difficulty': self.world.difficulty,
+                    'waves': self.__wave,
+                    'outcome': outcome,
+                    'score': self.__score,
+                    'duration': int(engine.clock.getTime() - self.__gameTimer),
+                    'enemiesDestroyed': self.__gameTotals['enemiesDestroyed'],
+                    'ammoFired': self.__gameTotals['ammoFired'],
+                })
+
+    def __saveSnapshot(self, waveEnded=False):
+        self.__lastSnapshot = engine.clock.getTime()
+        writer = app.instance.mainDiv.snapshots
+        if writer is not None:
+            writer.save(self.getSnapshot(waveEnded))
+
+    def __clearSnapshot(self):
+        writer = app.instance.mainDiv.snapshots
+        if writer is not None:
+            writer.clear()
+
+    def __restore(self, data):
+        now = engine.clock.getTime()
+        self.__wave = data['wave']
+        self.setScore(data['score'])
+        self.__gameTotals = dict(data['gameTotals'])
+        self.__gameTimer = now - data['gameTime']
+        self.__lastSnapshot = now
+
+        if data.get('waveEnded'):
+            self.world.difficulty = data['world']['difficulty']
+            logger.info('Resuming after wave %d' % self.__wave)
+            self.nextWave()
+            return
+
+        self.gameData = dict(data['gameData'])
+        self.nukeFired = data['nukeFired']
+        self.__enemiesGone = data['enemiesGone']
+        self.__lowAmmoNotified = data['lowAmmoNotified']
+        self.__enemiesSpawnTimeline = list(data['spawnTimeline'])
+        self.__waveTimer = now - data['waveTime']
+        self.__frameTimes = []
+
+        self.world.restoreSnapshot(data['world'])
+
+        if self.__lowAmmoNotified:
+            self.__ammoGauge.setColor(consts.COLOR_RED)
+        else:
+            self.__ammoGauge.setColor(consts.COLOR_BLUE)
+        self.updateAmmoGauge()
+        self.__updateEnemiesGauge()
+
+        self.playTeaser('Wave %d' % self.__wave)
+        self.__changeGameState(data['gameState'])
+        logger.info('Resumed wave %d: %s' % (self.__wave, str(self.gameData)))
+
     def __onExit(self):
+        self.__logWave(analytics.OUTCOME_ABORTED)
+        self.__clearSnapshot()
         self.sequencer.changeState('start')
 
 
@@ -553,16 +740,17 @@ class Results(engine.FadeGameState):
 
     def _postTransIn(self):
         gameState = self.sequencer.getState('game')
+        world = gameState.world
         self.rows = [
             'Enemies destroyed: %d / %d' % (
                     gameState.gameData['enemiesDestroyed'],
                     gameState.gameData['initialEnemies'],
                 ),
             'Cities saved: %d / %d' % (
-                    len(Target.filter(City)),
+                    world.status.citiesAlive,
                     gameState.gameData['initialCities'],
                 ),
-            'Cities bonus: %d' % (len(Target.filter(City)) * consts.CITY_RESCUE_SCORE),
+            'Cities bonus: %d' % (world.status.citiesAlive * consts.CITY_RESCUE_SCORE),
         ]
 
         if self.sequencer.getState('game').nukeFired:
@@ -572,10 +760,10 @@ class Results(engine.FadeGameState):
             self.rows.append(
                 'EMP Missiles launched: %d (%d%% accuracy)' % (
                         gameState.gameData['ammoFired'],
-                        self.__getAccuracy()))
+                        gameState.getAccuracy()))
 
-        gameState.addScore(len(Target.filter(City)) * consts.CITY_RESCUE_SCORE *
-                (1 + app.instance.mainDiv.difficultyLevel * 0.3))
+        gameState.addScore(world.status.citiesAlive * consts.CITY_RESCUE_SCORE *
+                (1 + world.difficulty * 0.3))
 
         avg.EaseInOutAnim(self.__resultHeader, 'y', consts.RESULTS_ADDROW_DELAY / 2,
                 engine.norm.size.y / 2,
@@ -586,23 +774,19 @@ class Results(engine.FadeGameState):
     def returnToGame(self):
         self.sequencer.changeState('game')
 
+    def _update(self, dt):
+        # Spare frame time while the rows are shown
+        self.sequencer.getState('game').prepareNextWave(consts.WAVE_PREPARE_BUDGET)
+
     def __addResultRow(self):
         row = self.rows[0]
         self.rows.remove(row)
         self.__resultsParagraph.text += row + '<br/>'
 
         if self.rows:
-            player.setTimeout(consts.RESULTS_ADDROW_DELAY, self.__addResultRow)
-        else:
-            player.setTimeout(consts.RESULTS_DELAY, self.returnToGame)
-
-    def __getAccuracy(self):
-        mfired = self.sequencer.getState('game').gameData['ammoFired']
-        if mfired == 0:
-            return 0
+            engine.clock.setTimeout(consts.RESULTS_ADDROW_DELAY, self.__addResultRow)
         else:
-            return (float(self.sequencer.getState('game').gameData['enemiesDestroyed']) /
-                    self.sequencer.getState('game').gameData['ammoFired'] * 100)
+            engine.clock.setTimeout(consts.RESULTS_DELAY, self.returnToGame)
 
 
 class GameOver(engine.FadeGameState):
@@ -622,10 +806,10 @@ class GameOver(engine.FadeGameState):
         db = app.instance.mainDiv.scoreDatabase
         if not db.isFull() or db.data[-1].points < \
                 self.sequencer.getState('game').getScore():
-            player.setTimeout(consts.GAMEOVER_DELAY / 2,
+            engine.clock.setTimeout(consts.GAMEOVER_DELAY / 2,
                 lambda: self.sequencer.changeState('hiscore'))
         else:
-            player.setTimeout(consts.GAMEOVER_DELAY,
+            engine.clock.setTimeout(consts.GAMEOVER_DELAY,
                     lambda: self.sequencer.changeState('start'))
 
 
@@ -682,7 +866,7 @@ class Hiscore(engine.FadeGameState):
 
     def __clearTimeout(self):
         if self.__timeout is not None:
-            player.clearInterval(self.__timeout)
+            engine.clock.clearInterval(self.__timeout)
 
     def __resetTimeout(self):
         def fire():
@@ -691,18 +875,18 @@ class Hiscore(engine.FadeGameState):
             self.sequencer.changeState('start')
 
         self.__clearTimeout()
-        self.__timeout = player.setTimeout(self.TIMEOUT, fire)
+        self.__timeout = engine.clock.setTimeout(self.TIMEOUT, fire)
 
     def __onKeyTouch(self, key):
         self.__resetTimeout()
         if key == '<':
-            engine.SoundManager.play('selection.ogg', volume=0.5)
+            engine.sounds.play('selection.ogg', volume=0.5)
             self.__playerName.delete()
         elif key == '#':
-            engine.SoundManager.play('click.ogg')
+            engine.sounds.play('click.ogg')
             self.__saveScore()
             self.__clearTimeout()
             self.sequencer.changeState('start')
         else:
-            engine.SoundManager.play('selection.ogg', volume=0.5)
+            engine.sounds.play('selection.ogg', volume=0.5)
             self.__playerName.addChar(key)
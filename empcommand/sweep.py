@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EMP Command: a missile command multitouch clone
+# Copyright (c) 2010-2020 OXullo Intersecans <x@brainrapers.org>. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+#    conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list
+#    of conditions and the following disclaimer in the documentation and/or other
+#    materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY OXullo Intersecans ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+# FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL OXullo Intersecans OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those of the
+# authors and should not be interpreted as representing official policies, either
+# expressed or implied, of OXullo Intersecans.
+
+import os
+import json
+import logging
+import itertools
+import multiprocessing
+import Queue
+
+import libavg
+
+import engine
+import consts
+import recorder
+import gameobjs
+import bot
+import soak
+
+
+logger = logging.getLogger(__name__)
+
+
+def parseValue(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def resolveParam(name):
+    '''
+    Returns the object and the attribute a sweep parameter refers to.
+    Plain names are looked up in consts, Class.ATTR in gameobjs
+    (eg: EmpExplosion.RADIUS)
+    '''
+    if '.' in name:
+        className, attr = name.split('.', 1)
+        target = getattr(gameobjs, className, None)
+    else:
+        target, attr = consts, name
+
+    if target is None or not hasattr(target, attr):
+        raise ValueError('Unknown parameter %s' % name)
+
+    return target, attr
+
+
+def applyOverrides(overrides):
+    for name, value in overrides.items():
+        target, attr = resolveParam(name)
+        setattr(target, attr, value)
+
+
+def expandGrid(params):
+    '''params: list of (name, [values]), returns a list of configurations'''
+    names = [p[0] for p in params]
+    return [dict(zip(names, values))
+            for values in itertools.product(*[p[1] for p in params])]
+
+
+class SweepDriver(object):
+    '''
+    Plays a number of games on a configuration with a bot player, reporting
+    the outcome of every wave to the sink queue
+    '''
+    def __init__(self, configIndex, overrides, sink, games=1, maxWaves=10,
+            difficulty=1, touchRate=2.5, fingers=1, skill=0.7):
+        self.configIndex = configIndex
+        self.overrides = overrides
+        self.sink = sink
+        self.games = games
+        self.maxWaves = maxWaves
+        self.difficulty = difficulty
+        self.touchRate = touchRate
+        self.fingers = fingers
+        self.skill = skill
+
+        self.__mainDiv = None
+        self.__bot = None
+        self.__game = 0
+        self.__lastHandle = None
+        self.__lastTime = None
+        self.__pendingRecord = None
+
+    def attach(self, mainDiv):
+        self.__mainDiv = mainDiv
+        mainDiv.difficultyLevel = self.difficulty
+        self.__bot = bot.Bot(mainDiv, touchRate=self.touchRate, fingers=self.fingers,
+                skill=self.skill)
+
+    def step(self):
+        now = engine.clock.getTime()
+        dt = now - self.__lastTime if self.__lastTime is not None else 0
+        self.__lastTime = now
+
+        sequencer = self.__mainDiv.sequencer
+        handle = sequencer.getCurrentHandle()
+        game = sequencer.getState('game')
+
+        if handle != self.__lastHandle:
+            self.__lastHandle = handle
+            self.__bot.reset()
+
+            if self.__pendingRecord is not None:
+                # City bonus is accounted once the results screen is gone
+                self.__pendingRecord['score'] = game.getScore()
+                self.__emit(self.__pendingRecord)
+                self.__pendingRecord = None
+
+            if handle == 'results':
+                self.__pendingRecord = self.__getWaveRecord(game, gameOver=False)
+            elif handle == 'gameover':
+                record = self.__getWaveRecord(game, gameOver=True)
+                record['score'] = game.getScore()
+                self.__emit(record)
+                self.__endGame()
+            elif handle == 'game' and game.getLevel() >= self.maxWaves:
+                self.__endGame()
+                if self.__game < self.games:
+                    game.setNewGame()
+            elif handle == 'start':
+                self.__startGame()
+
+        if handle == 'game':
+            self.__bot.update(dt)
+
+    def __startGame(self):
+        if self.__game >= self.games:
+            return
+
+        self.__mainDiv.sequencer.getState('game').setNewGame()
+        self.__mainDiv.sequencer.changeState('game')
+
+    def __endGame(self):
+        self.__game += 1
+        if self.__game >= self.games:
+            libavg.player.stop()
+
+    def __getWaveRecord(self, game, gameOver):
+        gameData = game.gameData
+        if gameData['ammoFired']:
+            accuracy = float(gameData['enemiesDestroyed']) / gameData['ammoFired']
+        else:
+            accuracy = 0
+
+        return {
+            'config': self.configIndex,
+            'params': self.overrides,
+            'difficulty': self.difficulty,
+            'game': self.__game,
+            'wave': game.getLevel(),
+            'gameOver': gameOver,
+            'citiesSaved': game.world.status.citiesAlive,
+            'initialCities': gameData['initialCities'],
+            'enemiesDestroyed': gameData['enemiesDestroyed'],
+            'initialEnemies': gameData['initialEnemies'],
+            'ammoFired': gameData['ammoFired'],
+            'initialAmmo': gameData['initialAmmo'],
+            'accuracy': accuracy,
+        }
+
+    def __emit(self, record):
+        self.sink.put(record)
+
+
+class SweepEmpCommand(soak.SoakEmpCommand):
+    HISCORE_FILE = 'hiscore-sweep'
+
+
+def isolateWorker():
+    '''
+    Keeps the pool workers off the outputs they would share with the parent
+    environment: the metrics server port is left free and the flight recorder
+    dumps to a directory of its own. Analytics and snapshots are disabled by
+    SoakEmpCommand.
+    '''
+    os.environ.pop('EMP_METRICS_PORT', None)
+    consts.METRICS_PORT = ''
+
+    if recorder.flight.enabled:
+        recorder.flight.directory = os.path.join(recorder.flight.directory,
+                'sweep-%d' % os.getpid())
+
+
+def runConfiguration(args):
+    '''Pool worker: plays a configuration in a fresh process'''
+    configIndex, difficulty, overrides, sink, options = args
+
+    isolateWorker()
+    applyOverrides(overrides)
+    engine.setClock(engine.createClock(options.pop('clock', 'free')))
+    resolution = options.pop('resolution', '1280x800')
+
+    mainDiv = SweepEmpCommand()
+    mainDiv.driver = SweepDriver(configIndex, overrides, sink, difficulty=difficulty,
+            **options)
+    libavg.app.App().run(mainDiv, app_resolution=resolution, app_fullscreen='false')
+
+    return configIndex
+
+
+def run(configurations, outFile, processes=None, **options):
+    '''
+    Fans the configurations, (difficulty, overrides) tuples, out across a pool of
+    processes (one per core by default), streaming the per-wave records to
+    outFile as JSON lines
+    '''
+    for difficulty, overrides in configurations:
+        for name in overrides:
+            resolveParam(name)
+
+    manager = multiprocessing.Manager()
+    sink = manager.Queue()
+    # Every configuration gets a fresh process: libavg can't be restarted and
+    # the overrides must not leak
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count(),
+            maxtasksperchild=1)
+
+    tasks = [(i, difficulty, overrides, sink, dict(options))
+            for i, (difficulty, overrides) in enumerate(configurations)]
+    result = pool.map_async(runConfiguration, tasks, chunksize=1)
+    pool.close()
+
+    records = 0
+    with open(outFile, 'a') as f:
+        while not result.ready() or not sink.empty():
+            try:
+                record = sink.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            records += 1
+
+    pool.join()
+    # Re-raise worker failures
+    result.get()
+
+    logger.info('Sweep completed: %d configurations, %d records written to %s' % (
+            len(configurations), records, outFile))
+
+    return records
@@ -33,6 +33,13 @@ from libavg import avg, Point2D, app
 
 import engine
 import consts
+import assets
+import glyphs
+
+
+def scheduleUpdate(widget):
+    '''Defers the node writes of widget to the end of the frame, see DeferredUpdates'''
+    app.instance.mainDiv.updates.schedule(widget)
 
 
 class GameWordsNode(avg.WordsNode):
@@ -43,6 +50,138 @@ class GameWordsNode(avg.WordsNode):
             kwargs['fontsize'] = max(engine.norm.y(kwargs['fontsize']), 7)
         super(GameWordsNode, self).__init__(**kwargs)
         self.registerInstance(self, parent)
+        self._dirty = False
+        self.__pendingText = None
+
+    def setText(self, text):
+        '''Deferred text update, laid out once per frame at most'''
+        self.__pendingText = text
+        scheduleUpdate(self)
+
+    def _flush(self):
+        if self.__pendingText != self.text:
+            self.text = self.__pendingText
+
+
+class GlyphText(avg.DivNode):
+    '''
+    Single line text made of quads cut out of a glyph atlas (glyphs.GlyphFace):
+    changing the text or the scale only moves a few quads, instead of laying
+    out the font again. Meant for short, often updated texts.
+    Falls back to a GameWordsNode for characters missing from the atlas, or
+    when the atlas isn't available.
+    pos is the top of the text, at its left, center or right (see alignment)
+    '''
+    def __init__(self, text='', fontsize=15, color='ffffff', alignment='left',
+            parent=None, **kwargs):
+        kwargs['sensitive'] = False
+        super(GlyphText, self).__init__(**kwargs)
+        self.registerInstance(self, parent)
+
+        self.__fontsize = fontsize
+        self.__face = self.preload(fontsize)
+        self.__intensity = glyphs.getIntensity(color)
+        self.__color = color
+        self.__alignment = alignment
+        self.__scale = 1
+        self.__text = ''
+        # (clipping div, atlas image) pairs, the unused ones are inactive
+        self.__quads = []
+        self.__fallback = None
+        self._dirty = False
+        self.__pendingText = None
+
+        self.text = text
+
+    @staticmethod
+    def preload(fontsize):
+        '''Builds the atlas of a font size ahead of the first text using it'''
+        return glyphs.atlas.getFace(max(engine.norm.y(fontsize), 7))
+
+    def getText(self):
+        return self.__text
+
+    def setText(self, text):
+        '''Deferred text update, see GameWordsNode.setText()'''
+        self.__pendingText = text
+        scheduleUpdate(self)
+
+    def __setText(self, text):
+        if text != self.__text:
+            self.__text = text
+            self.__layout()
+
+    text = property(getText, __setText)
+
+    def getScale(self):
+        return self.__scale
+
+    def setScale(self, scale):
+        if scale != self.__scale:
+            self.__scale = scale
+            self.__layout()
+
+    scale = property(getScale, setScale)
+
+    def _flush(self):
+        self.text = self.__pendingText
+
+    def __layout(self):
+        if self.__face is None or not self.__face.hasGlyphs(self.__text):
+            self.__layoutFallback()
+            return
+
+        if self.__fallback is not None:
+            self.__fallback.active = False
+
+        face = self.__face
+        scale = self.__scale
+        width = 0
+        for char in self.__text:
+            width += face.spaceAdvance if char == ' ' else face.glyphs[char][1].x
+
+        x = {'left': 0, 'center': -width / 2.0, 'right': -width}[self.__alignment]
+        x *= scale
+        index = 0
+        for char in self.__text:
+            if char == ' ':
+                x += face.spaceAdvance * scale
+                continue
+
+            origin, size = face.glyphs[char]
+            clip, image = self.__getQuad(index)
+            clip.pos = (x, 0)
+            clip.size = size * scale
+            image.pos = origin * -scale
+            image.size = face.size * scale
+            x += size.x * scale
+            index += 1
+
+        for clip, image in self.__quads[index:]:
+            clip.active = False
+
+    def __getQuad(self, index):
+        if index == len(self.__quads):
+            clip = avg.DivNode(crop=True, parent=self)
+            image = avg.ImageNode(href=self.__face.href, intensity=self.__intensity,
+                    parent=clip)
+            self.__quads.append((clip, image))
+
+        clip, image = self.__quads[index]
+        clip.active = True
+        return clip, image
+
+    def __layoutFallback(self):
+        for clip, image in self.__quads:
+            clip.active = False
+
+        if self.__fallback is None:
+            self.__fallback = GameWordsNode(fontsize=self.__fontsize, color=self.__color,
+                    alignment=self.__alignment, rawtextmode=True, parent=self)
+
+        self.__fallback.active = True
+        self.__fallback.text = self.__text
+        self.__fallback.fontsize = max(engine.norm.y(self.__fontsize * self.__scale), 7)
 
 
 class VLayout(avg.DivNode):
@@ -129,7 +268,7 @@ class MenuItem(avg.DivNode):
                 self.curState = 0
 
     def executeCallback(self):
-        engine.SoundManager.play('click.ogg')
+        engine.sounds.play('click.ogg')
         self.cb()
 
 
@@ -142,7 +281,7 @@ class DifficultyMenuItem(MenuItem):
         self.__setText()
 
     def executeCallback(self):
-        engine.SoundManager.play('click.ogg')
+        engine.sounds.play('click.ogg')
         self.__lptr = (self.__lptr + 1) % 3
         self.__setText()
         self.cb(self.__lptr)
@@ -176,7 +315,7 @@ class Menu(avg.DivNode):
         self.__active = idx
 
         if fb:
-            engine.SoundManager.play('selection.ogg', volume=0.5)
+            engine.sounds.play('selection.ogg', volume=0.5)
 
     def update(self, dt):
         self.layout.objs[self.__active].update(dt)
@@ -222,8 +361,8 @@ class HiscoreTab(avg.DivNode):
         self.__scrollLock = False
         self.__speedFactor = engine.norm.y(self.SPEED_FACTOR)
         self.subscribe(self.CURSOR_DOWN, self.__onTouchDown)
-        self.subscribe(self.CURSOR_MOTION, self.__onMotion)
-        self.subscribe(self.CURSOR_UP, self.__onTouchUp)
+        self.subscribe(self.CURSOR_MOTION, engine.motion.coalesce(self.__onMotion))
+        self.subscribe(self.CURSOR_UP, engine.motion.release(self.__onTouchUp))
 
     def toCardinal(self, num):
         if num % 10 == 1:
@@ -265,7 +404,7 @@ class HiscoreTab(avg.DivNode):
             self.__lastYSpeed /= self.SMOOTH_FACTOR
             self.__clampPan()
         elif not self.__scrollLock:
-            self.__stage.y -= self.SMOOTH_FACTOR
+            self.__stage.y -= self.SMOOTH_FACTOR * dt / consts.DELTAT_NORM_FACTOR
             if self.__stage.y < -self.__stage.height:
                 self.__stage.y = self.height
 
@@ -289,7 +428,8 @@ class HiscoreTab(avg.DivNode):
                 self.__lastYSpeed = event.speed.y / event.speed.y * self.MAX_SPEED
             else:
                 self.__lastYSpeed = event.speed.y
-            self.__stage.y += event.speed.y * self.__speedFactor
+            # Same pan as if the merged events were applied one by one
+            self.__stage.y += event.speed.y * event.count * self.__speedFactor
             self.__clampPan()
 
     def __onTouchUp(self, event):
@@ -425,6 +565,8 @@ class Gauge(avg.DivNode):
                 parent=self.__levelContainer)
 
         self.__fval = 0
+        self.__color = color
+        self._dirty = False
 
     def getFVal(self):
         return self.__fval
@@ -435,6 +577,15 @@ class Gauge(avg.DivNode):
         elif fv < 0:
             fv = 0
 
+        self.__fval = fv
+        scheduleUpdate(self)
+
+    def setColor(self, color):
+        self.__color = color
+        scheduleUpdate(self)
+
+    def _flush(self):
+        fv = self.__fval
         if self.__layout == self.LAYOUT_VERTICAL:
             self.__level.pos = Point2D(0, self.size.y * (1 - fv))
             self.__level.size = self.size - Point2D(0, self.__level.pos.y)
@@ -442,10 +593,8 @@ class Gauge(avg.DivNode):
             self.__level.pos = Point2D(0, 0)
             self.__level.size = Point2D(self.size.x * fv, self.size.y)
 
-        self.__fval = fv
-
-    def setColor(self, color):
-        self.__level.fillcolor = color
+        if self.__level.fillcolor != self.__color:
+            self.__level.fillcolor = self.__color
 
     def setOpacity(self, opacity):
         self.__levelContainer.opacity = opacity
@@ -468,6 +617,7 @@ class CrossHair(avg.DivNode):
         self.__l1 = avg.LineNode(pos1=(10, 0), pos2=(10, 20), strokewidth=4, parent=self)
         self.__l2 = avg.LineNode(pos1=(0, 10), pos2=(20, 10), strokewidth=4, parent=self)
         self.size = (20, 20)
+        self.__warning = None
 
     def refresh(self):
         if self.warningy > 0 and self.pos.y > self.warningy:
@@ -476,6 +626,10 @@ class CrossHair(avg.DivNode):
             self.__setWarning(False)
 
     def __setWarning(self, warning):
+        if warning == self.__warning:
+            return
+
+        self.__warning = warning
         if warning:
             self.__l1.color = self.__l2.color = self.WARNING_COLOR
         else:
@@ -485,28 +639,45 @@ class CrossHair(avg.DivNode):
 class Clouds(avg.ImageNode):
     def __init__(self, maxOpacity, parent=None, **kwargs):
         kwargs['href'] = 'clouds.png'
+        if 'size' in kwargs:
+            kwargs['href'] = assets.cache.getScaled(kwargs['href'], kwargs['size'])
         super(Clouds, self).__init__(**kwargs)
         self.registerInstance(self, parent)
 
         self.opacity = 0
         self.maxOpacity = maxOpacity
+        self.__blinks = 0
 
     def blink(self):
+        # Busy frames: only one out of cloudBlinkRatio blinks goes through
+        self.__blinks += 1
+        ratio = engine.quality.cloudBlinkRatio
+        if not ratio or self.__blinks % ratio:
+            return
+
         def reset():
             avg.Anim.fadeOut(self, 180)
         avg.Anim.fadeIn(self, 80, random.uniform(0.05, self.maxOpacity), reset)
 
 
-class RIImage(avg.ImageNode):
-    def __init__(self, lock='x', parent=None, **kwargs):
-        super(RIImage, self).__init__(**kwargs)
+class PrescaledImage(avg.ImageNode):
+    '''Image drawn at a fixed size, loaded pre-scaled from the asset cache'''
+    def __init__(self, href, size, parent=None, **kwargs):
+        super(PrescaledImage, self).__init__(href=assets.cache.getScaled(href, size),
+                size=size, **kwargs)
         self.registerInstance(self, parent)
+
+
+class RIImage(PrescaledImage):
+    def __init__(self, href, lock='x', parent=None, **kwargs):
         if lock == 'x':
             nf = engine.norm.x
         else:
             nf = engine.norm.y
 
-        self.size = (nf(self.getMediaSize().x), nf(self.getMediaSize().y))
+        mediaSize = assets.cache.getMediaSize(href)
+        super(RIImage, self).__init__(href, (nf(mediaSize.x), nf(mediaSize.y)),
+                parent=parent, **kwargs)
 
 
 class ExitButton(avg.DivNode):
@@ -543,8 +714,9 @@ class QuitSwitch(avg.DivNode):
         self.__xlimit = engine.norm.x(self.BUTTON_RIGHT_XLIMIT)
 
         self.__button.subscribe(self.CURSOR_DOWN, self.__onDown)
-        self.__button.subscribe(self.CURSOR_UP, self.__onUp)
-        self.__button.subscribe(self.CURSOR_MOTION, self.__onMotion)
+        self.__button.subscribe(self.CURSOR_UP, engine.motion.release(self.__onUp))
+        self.__button.subscribe(self.CURSOR_MOTION,
+                engine.motion.coalesce(self.__onMotion))
 
         self.reset()
 
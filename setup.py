@@ -11,7 +11,9 @@ setup(
     url='http://www.brainrapers.org/empcommand/',
     license='BSD',
     packages=['empcommand'],
-    scripts=['scripts/empcommand'],
+    scripts=['scripts/empcommand', 'scripts/empcommand-soak',
+            'scripts/empcommand-sweep', 'scripts/empcommand-rollup',
+            'scripts/empcommand-assets', 'scripts/empcommand-flightlog'],
     package_data={
             'empcommand': ['media/*.png', 'media/snd/*.ogg', 'fonts/*.ttf'],
     }